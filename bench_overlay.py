@@ -0,0 +1,67 @@
+"""Microbenchmark for live stream overlay compositing.
+
+Compares the original full-frame overlay (img.copy() + cv2.addWeighted over
+the whole image) with OverlayEngine, which darkens and blends only the banner
+rows in place. Run from the app directory:
+
+    python bench_overlay.py [frames]
+"""
+
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from pp import OverlayEngine
+
+RESOLUTIONS = {
+    "720p": (720, 1280),
+    "1080p": (1080, 1920),
+}
+
+
+def full_frame_overlay(img, text):
+    """The overlay as VideoProcessor used to draw it"""
+    height, width = img.shape[:2]
+    overlay = img.copy()
+    cv2.rectangle(overlay, (0, 0), (width, 50), (0, 0, 0), -1)
+    cv2.addWeighted(overlay, 0.5, img, 0.5, 0, img)
+    cv2.putText(img, text, (10, 35), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+    return img
+
+
+def time_per_frame(fn, img, frames):
+    """Average wall time per call in microseconds"""
+    fn(img)  # warm up caches and pre-rendered layers
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn(img)
+    return (time.perf_counter() - start) / frames * 1e6
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    print(f"{'resolution':<12}{'overlay':<28}{'us/frame':>10}")
+    for label, (height, width) in RESOLUTIONS.items():
+        img = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+
+        single = OverlayEngine()
+        single.set("viewers", "Viewers: 42")
+
+        stacked = OverlayEngine()
+        stacked.set("title", "Morning coffee stream")
+        stacked.set("viewers", "Viewers: 42")
+
+        cases = [
+            ("full frame (legacy)", lambda frame: full_frame_overlay(frame, "Viewers: 42")),
+            ("ROI engine, 1 band", single.apply),
+            ("ROI engine, 2 bands", stacked.apply),
+        ]
+        for name, fn in cases:
+            print(f"{label:<12}{name:<28}{time_per_frame(fn, img, frames):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import sqlite3
 import datetime
 import random
 import time
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps, features
 import io
 import base64
 import json
@@ -14,9 +14,16 @@ import secrets
 import os
 import threading
 import queue
+import mmap
+import asyncio
+import collections
+import weakref
+from contextlib import contextmanager
 import cv2
 import numpy as np
 from streamlit_webrtc import webrtc_streamer, WebRtcMode, RTCConfiguration
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
 import av
 import queue
 from dataclasses import dataclass
@@ -45,8 +52,64 @@ THEME_CONFIG = {
         "border": "#333333"
     },
     "max_file_size": 100 * 1024 * 1024,
+    "database": {
+        "path": "feedchat.db",
+        "busy_timeout_ms": 5000,
+        "cache_size_kb": 32 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "max_idle_connections": 16
+    },
+    "media": {
+        "root": "media",
+        "avatar_sizes": [40, 100, 200],
+        "feed_width": 720,
+        "grid_size": 300,
+        "rendition_quality": 80
+    },
+    "presence": {
+        "online_ttl_seconds": 120,
+        "write_interval_seconds": 60,
+        "sweep_interval_seconds": 15
+    },
+    "events": {
+        "queue_size": 100,
+        "resync_seconds": 30.0
+    },
+    "cache": {
+        "user_ttl_seconds": 30.0,
+        "user_max_entries": 10000,
+        "avatar_max_entries": 1024,
+        "share_targets_ttl_seconds": 60.0,
+        "share_targets_limit": 50
+    },
+    "messages": {
+        "preview_chars": 100,
+        "page_size": 50,
+        "read_flush_seconds": 3.0,
+        "read_marks_max_entries": 10000,
+        "refresh_seconds": 3.0
+    },
+    "timeline": {
+        "celebrity_followers": 1000,
+        "backfill_posts": 50
+    },
+    "trending_windows": {
+        "1h": "-1 hours",
+        "24h": "-24 hours",
+        "7d": "-7 days"
+    },
     "supported_timezones": ["UTC", "EST", "PST", "GMT", "CET", "AEST"],
     "languages": ["en", "es", "fr", "de", "zh", "ja", "ko", "hi"],
+    "live": {
+        "viewer_buffer_frames": 4,
+        "simulcast_layers": [360, 540, 720],
+        "layer_check_seconds": 2.0,
+        "presence_ttl_seconds": 30.0,
+        "presence_flush_seconds": 5.0,
+        "chat_refresh_seconds": 2.0,
+        "chat_buffer_size": 200,
+        "chat_flush_seconds": 1.0
+    },
     "webrtc": {
         "ice_servers": [
             {"urls": ["stun:stun.l.google.com:19302"]},
@@ -55,19 +118,535 @@ THEME_CONFIG = {
     }
 }
 
+# ===================================
+# DATABASE CONNECTION POOL
+# ===================================
+
+class ConnectionPool:
+    """Hands out one SQLite connection per thread.
+
+    Streamlit runs every session's script in its own thread, so each session
+    gets a private connection instead of serializing on a shared one. All
+    connections run in WAL mode, which lets readers proceed while a writer
+    holds the lock. Connections owned by finished threads are reclaimed and
+    reused by the next thread that asks for one.
+    """
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000, cache_size_kb: int = 32 * 1024,
+                 mmap_size: int = 256 * 1024 * 1024, max_idle: int = 16):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle: List[sqlite3.Connection] = []
+        self._in_use: Dict[int, Tuple[threading.Thread, sqlite3.Connection]] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a new connection with the tuned pragmas applied"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            isolation_level=None
+        )
+        c = conn.cursor()
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+        c.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        c.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        c.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        c.execute("PRAGMA temp_store = MEMORY")
+        c.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _reclaim_locked(self):
+        """Return connections held by dead threads to the idle list"""
+        for ident, (thread, conn) in list(self._in_use.items()):
+            if thread.is_alive():
+                continue
+            del self._in_use[ident]
+            if conn.in_transaction:
+                conn.rollback()
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+            else:
+                conn.close()
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection owned by the calling thread"""
+        thread = threading.current_thread()
+        with self._lock:
+            entry = self._in_use.get(thread.ident)
+            if entry and entry[0] is thread:
+                return entry[1]
+            self._reclaim_locked()
+            conn = self._idle.pop() if self._idle else None
+
+        if conn is None:
+            conn = self._connect()
+
+        with self._lock:
+            self._in_use[thread.ident] = (thread, conn)
+        return conn
+
+    def close_all(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for _, conn in self._in_use.values():
+                conn.close()
+            for conn in self._idle:
+                conn.close()
+            self._in_use.clear()
+            self._idle.clear()
+
+@st.cache_resource
+def get_db_pool():
+    """Get the process-wide connection pool
+
+    Streamlit re-executes this script on every rerun, so the pool is kept in
+    st.cache_resource to be shared by all sessions and reruns.
+    """
+    return ConnectionPool(
+        THEME_CONFIG['database']['path'],
+        busy_timeout_ms=THEME_CONFIG['database']['busy_timeout_ms'],
+        cache_size_kb=THEME_CONFIG['database']['cache_size_kb'],
+        mmap_size=THEME_CONFIG['database']['mmap_size'],
+        max_idle=THEME_CONFIG['database']['max_idle_connections']
+    )
+
+def get_db_connection():
+    """Get the database connection for the current thread/session"""
+    return get_db_pool().connection()
+
+@contextmanager
+def db_transaction():
+    """Run a block of statements as a single IMMEDIATE transaction"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        yield c
+    except Exception:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+class BackgroundFlusher:
+    """Base for in-memory state written back to the database by a daemon thread
+
+    The thread starts on first use and calls tick() every interval, printing
+    errors instead of dying on them. Subclasses write with _batch(), which
+    rolls back on failure; they then put their unwritten changes back so the
+    next tick retries them.
+    """
+
+    thread_name = "BackgroundFlusher"
+
+    def __init__(self, pool: ConnectionPool, interval: float):
+        self.pool = pool
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"{self.thread_name} error: {e}")
+
+    def tick(self):
+        """One round of background work"""
+        self.flush()
+
+    def flush(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def _batch(self):
+        """Run a block as one IMMEDIATE transaction on this thread's connection"""
+        conn = self.pool.connection()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            yield c
+            c.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+
+# ===================================
+# MEDIA STORE
+# ===================================
+
+class MediaStore:
+    """Content-addressed media files on local disk
+
+    Every blob is stored once under root/<aa>/<sha256>, so identical uploads
+    are deduplicated and database rows only carry the hash. open() memory-maps
+    a blob for consumers that can decode straight from it; read() returns a
+    bytes copy for callers that keep or cache the data.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @staticmethod
+    def is_digest(digest) -> bool:
+        """Check that a value looks like a SHA-256 hex digest"""
+        return isinstance(digest, str) and re.fullmatch(r'[0-9a-f]{64}', digest) is not None
+
+    def path(self, digest: str) -> str:
+        """Get the file path for a digest"""
+        if not self.is_digest(digest):
+            raise ValueError(f"Invalid media digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        """Check whether a blob is stored"""
+        return self.is_digest(digest) and os.path.exists(self.path(digest))
+
+    def put(self, data: bytes) -> str:
+        """Store a blob and return its SHA-256 digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    @contextmanager
+    def open(self, digest: str):
+        """Memory-map a stored blob for reading"""
+        with open(self.path(digest), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def read(self, digest: str) -> Optional[bytes]:
+        """Read a stored blob, or None if it is missing"""
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def rendition_path(self, digest: str, variant: str) -> str:
+        """Get the file path for a derived variant of a blob"""
+        if not re.fullmatch(r'[a-z0-9]+', variant):
+            raise ValueError(f"Invalid rendition name: {variant!r}")
+        return f"{self.path(digest)}.{variant}"
+
+    def put_rendition(self, digest: str, variant: str, data: bytes):
+        """Store a derived variant next to its source blob"""
+        path = self.rendition_path(digest, variant)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read_rendition(self, digest: str, variant: str) -> Optional[bytes]:
+        """Read a derived variant, or None if it was never generated"""
+        try:
+            with open(self.rendition_path(digest, variant), 'rb') as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def size(self, digest: str) -> int:
+        """Get the size of a stored blob in bytes"""
+        try:
+            return os.path.getsize(self.path(digest))
+        except (OSError, ValueError):
+            return 0
+
+@st.cache_resource
+def get_media_store():
+    """Get the process-wide media store"""
+    return MediaStore(THEME_CONFIG['media']['root'])
+
+def store_media(data):
+    """Store uploaded bytes in the media store and return the digest"""
+    if not data:
+        return None
+    return get_media_store().put(data)
+
+def load_media(digest):
+    """Load media bytes by digest"""
+    if not digest:
+        return None
+    return get_media_store().read(digest)
+
+def _encode_rendition(img):
+    """Encode a rendition as WebP, or JPEG when Pillow lacks WebP support"""
+    buf = io.BytesIO()
+    quality = THEME_CONFIG['media']['rendition_quality']
+    if features.check('webp'):
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        img.save(buf, format='WEBP', quality=quality, method=4)
+    else:
+        img.convert('RGB').save(buf, format='JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+def create_renditions(digest, kind):
+    """Generate fixed-size variants of a stored image
+
+    kind is 'avatar' (square avatar{size} variants) or 'post' (a 'feed'
+    variant capped at the feed width plus a square 'grid' thumbnail).
+    Animated images and non-images are left alone.
+    """
+    if not digest:
+        return []
+    
+    store = get_media_store()
+    try:
+        with store.open(digest) as mm:
+            img = Image.open(mm)
+            if getattr(img, 'is_animated', False):
+                return []
+            img.load()
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        return []
+    
+    variants = {}
+    if kind == 'avatar':
+        for size in THEME_CONFIG['media']['avatar_sizes']:
+            variants[f"avatar{size}"] = ImageOps.fit(img, (size, size), Image.LANCZOS)
+    else:
+        feed_width = THEME_CONFIG['media']['feed_width']
+        feed_img = img
+        if img.width > feed_width:
+            feed_img = img.resize((feed_width, max(1, round(img.height * feed_width / img.width))), Image.LANCZOS)
+        variants['feed'] = feed_img
+        grid_size = THEME_CONFIG['media']['grid_size']
+        variants['grid'] = ImageOps.fit(img, (grid_size, grid_size), Image.LANCZOS)
+    
+    for variant, variant_img in variants.items():
+        store.put_rendition(digest, variant, _encode_rendition(variant_img))
+    return list(variants.keys())
+
+@st.cache_resource(max_entries=THEME_CONFIG['cache']['avatar_max_entries'])
+def _load_avatar_variant(digest, variant):
+    """Bytes of one avatar rendition, or of the original when variant is None
+
+    Digests name immutable content, so the bytes are cached process-wide
+    with no invalidation; a new profile picture simply has a new digest.
+    A missing file raises instead of returning None so the miss is not
+    cached and a rendition generated later is picked up.
+    """
+    store = get_media_store()
+    data = store.read_rendition(digest, variant) if variant else store.read(digest)
+    if not data:
+        raise FileNotFoundError(f"No {variant or 'original'} stored for {digest}")
+    return data
+
+def load_avatar(digest, size):
+    """Load the smallest avatar variant that covers the requested size"""
+    variants = [f"avatar{avatar_size}" for avatar_size in sorted(THEME_CONFIG['media']['avatar_sizes'])
+                if avatar_size >= size]
+    for variant in variants + [None]:
+        try:
+            return _load_avatar_variant(digest, variant)
+        except FileNotFoundError:
+            continue
+    return None
+
+def load_rendition(digest, variant):
+    """Load a post image variant, falling back to the original upload"""
+    store = get_media_store()
+    return store.read_rendition(digest, variant) or store.read(digest)
+
+def migrate_media_renditions(c):
+    """Generate renditions for media stored before the rendition pipeline existed"""
+    c.execute("SELECT DISTINCT profile_pic_hash FROM users WHERE profile_pic_hash IS NOT NULL")
+    for (digest,) in c.fetchall():
+        create_renditions(digest, 'avatar')
+    
+    c.execute("SELECT DISTINCT media_hash FROM posts WHERE media_hash IS NOT NULL AND media_type LIKE 'image%'")
+    for (digest,) in c.fetchall():
+        create_renditions(digest, 'post')
+
+# ===================================
+# SCHEMA MIGRATIONS
+# ===================================
+
+def ensure_column(c, table, column, definition):
+    """Add a column to an existing table if it is missing"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def run_migration(c, name, migration):
+    """Run a one-shot data migration inside a transaction, once per database"""
+    c.execute("SELECT 1 FROM schema_migrations WHERE name = ?", (name,))
+    if c.fetchone():
+        return False
+    
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        migration(c)
+        c.execute("INSERT INTO schema_migrations (name) VALUES (?)", (name,))
+        c.execute("COMMIT")
+        return True
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+
+def migrate_media_blobs(c):
+    """Move post media and profile pictures out of table rows into the media store"""
+    c.execute("SELECT id FROM posts WHERE media_data IS NOT NULL")
+    for (post_id,) in c.fetchall():
+        c.execute("SELECT media_data FROM posts WHERE id = ?", (post_id,))
+        media_data = c.fetchone()[0]
+        digest = store_media(media_data)
+        c.execute("""
+            UPDATE posts SET media_hash = ?, media_size = ?, media_data = NULL WHERE id = ?
+        """, (digest, len(media_data) if media_data else 0, post_id))
+    
+    c.execute("SELECT id FROM users WHERE profile_pic IS NOT NULL")
+    for (user_id,) in c.fetchall():
+        c.execute("SELECT profile_pic FROM users WHERE id = ?", (user_id,))
+        digest = store_media(c.fetchone()[0])
+        c.execute("UPDATE users SET profile_pic_hash = ?, profile_pic = NULL WHERE id = ?", (digest, user_id))
+
+def migrate_message_thread_keys(c):
+    """Fill in the thread key of messages written before it existed"""
+    c.execute("""
+        UPDATE messages 
+        SET thread_key = MIN(sender_id, receiver_id) || ':' || MAX(sender_id, receiver_id)
+        WHERE thread_key IS NULL
+    """)
+
+def migrate_conversations(c):
+    """Build conversation summaries from existing message history"""
+    c.execute("""
+        INSERT OR REPLACE INTO conversations 
+            (user_low, user_high, last_message_id, last_message, last_message_at, unread_low, unread_high)
+        SELECT lo, hi, id, substr(content, 1, ?), created_at,
+            (SELECT COUNT(*) FROM messages WHERE sender_id = hi AND receiver_id = lo AND is_read = 0),
+            (SELECT COUNT(*) FROM messages WHERE sender_id = lo AND receiver_id = hi AND is_read = 0)
+        FROM (
+            SELECT MIN(sender_id, receiver_id) AS lo, MAX(sender_id, receiver_id) AS hi,
+                id, content, created_at,
+                ROW_NUMBER() OVER (
+                    PARTITION BY MIN(sender_id, receiver_id), MAX(sender_id, receiver_id)
+                    ORDER BY created_at DESC, id DESC
+                ) AS rn
+            FROM messages
+        )
+        WHERE rn = 1
+    """, (THEME_CONFIG['messages']['preview_chars'],))
+
+def migrate_post_hashtags(c):
+    """Index the hashtags of existing posts"""
+    c.execute("SELECT id, hashtags, created_at FROM posts WHERE hashtags IS NOT NULL AND hashtags != ''")
+    c.executemany("""
+        INSERT OR IGNORE INTO post_hashtags (tag, post_id, created_at) VALUES (?, ?, ?)
+    """, [(tag.strip().lstrip('#').lower(), post_id, created_at)
+          for post_id, hashtags, created_at in c.fetchall()
+          for tag in hashtags.split(',') if tag.strip().lstrip('#')])
+
+def create_search_index(c, table, columns):
+    """Create an FTS5 index over columns of a table, kept in sync by triggers
+
+    The index is external-content: it stores only the search terms and
+    reads column values back from the table by rowid.
+    """
+    fts = f"{table}_fts"
+    cols = ", ".join(columns)
+    new_values = ", ".join(f"new.{col}" for col in columns)
+    old_values = ", ".join(f"old.{col}" for col in columns)
+    
+    c.execute(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+        {cols}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+    END
+    """)
+    # Only edits to indexed columns touch the index (not e.g. is_online or like_count)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON {table} BEGIN
+        INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+    END
+    """)
+
+def migrate_search_indexes(c):
+    """Index rows that existed before full-text search"""
+    for fts in ("users_fts", "posts_fts", "messages_fts"):
+        c.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+@st.cache_resource
+def search_index_exists(fts):
+    """Whether a full-text index was created (it is missing when SQLite lacks FTS5)"""
+    c = get_db_connection().cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,))
+    return c.fetchone() is not None
+
+def reconcile_counters(c):
+    """Recompute every denormalized counter from the rows it counts"""
+    c.execute("""
+        UPDATE posts SET
+            like_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.id),
+            comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.id)
+    """)
+    c.execute("""
+        UPDATE users SET
+            post_count = (SELECT COUNT(*) FROM posts WHERE posts.user_id = users.id AND posts.is_deleted = 0),
+            follower_count = (SELECT COUNT(*) FROM follows WHERE follows.following_id = users.id),
+            following_count = (SELECT COUNT(*) FROM follows WHERE follows.follower_id = users.id),
+            total_likes = (SELECT COALESCE(SUM(posts.like_count), 0) FROM posts WHERE posts.user_id = users.id)
+    """)
+
+def migrate_timelines(c):
+    """Build home timelines from existing posts and follows"""
+    c.execute("""
+        INSERT OR IGNORE INTO timelines (user_id, post_id, created_at)
+        SELECT user_id, id, created_at FROM posts WHERE is_deleted = 0
+    """)
+    c.execute("""
+        INSERT OR IGNORE INTO timelines (user_id, post_id, created_at)
+        SELECT f.follower_id, p.id, p.created_at
+        FROM follows f
+        JOIN users u ON u.id = f.following_id AND u.follower_count <= ?
+        JOIN posts p ON p.user_id = f.following_id AND p.is_deleted = 0 AND p.visibility != 'private'
+    """, (THEME_CONFIG['timeline']['celebrity_followers'],))
+
 # ===================================
 # DATABASE SETUP
 # ===================================
 
+@st.cache_resource
 def init_simple_db():
     """Initialize database with essential tables"""
     try:
-        conn = sqlite3.connect("feedchat.db", check_same_thread=False, isolation_level=None)
+        conn = get_db_connection()
         c = conn.cursor()
-        
-        # Enable foreign keys
-        c.execute("PRAGMA foreign_keys = ON")
-        
+
         # Users table
         c.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -77,6 +656,7 @@ def init_simple_db():
             password_hash TEXT,
             email TEXT,
             profile_pic BLOB,
+            profile_pic_hash TEXT,
             bio TEXT,
             location TEXT DEFAULT 'Unknown',
             timezone TEXT DEFAULT 'UTC',
@@ -113,6 +693,8 @@ def init_simple_db():
             view_count INTEGER DEFAULT 0,
             hashtags TEXT DEFAULT '',
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            media_hash TEXT,
+            media_size INTEGER DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
         """)
@@ -129,11 +711,63 @@ def init_simple_db():
             call_data TEXT,
             is_read BOOLEAN DEFAULT FALSE,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            thread_key TEXT,
             FOREIGN KEY (sender_id) REFERENCES users(id) ON DELETE CASCADE,
             FOREIGN KEY (receiver_id) REFERENCES users(id) ON DELETE CASCADE
         )
         """)
 
+        # Conversation summaries, one row per ordered user pair
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_low INTEGER NOT NULL,
+            user_high INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message TEXT,
+            last_message_at DATETIME,
+            unread_low INTEGER DEFAULT 0,
+            unread_high INTEGER DEFAULT 0,
+            PRIMARY KEY (user_low, user_high),
+            FOREIGN KEY (user_low) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_high) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """)
+
+        # Read receipts: the newest message each user has seen in a thread
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS read_receipts (
+            user_id INTEGER NOT NULL,
+            thread_key TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, thread_key),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """)
+
+        # Hashtag index, one row per tag on a post
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS post_hashtags (
+            tag TEXT NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (tag, post_id),
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+        )
+        """)
+
+        # Home timelines: posts pushed to each follower when they are created
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS timelines (
+            user_id INTEGER NOT NULL,
+            post_id INTEGER NOT NULL,
+            created_at DATETIME NOT NULL,
+            PRIMARY KEY (user_id, created_at, post_id),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """)
+
         # Streams table for live streaming
         c.execute("""
         CREATE TABLE IF NOT EXISTS streams (
@@ -264,103 +898,752 @@ def init_simple_db():
 
         # Create indexes
         c.execute("CREATE INDEX IF NOT EXISTS idx_posts_user ON posts(user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_posts_feed ON posts(is_deleted, visibility, created_at, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_posts_user_feed ON posts(user_id, is_deleted, created_at, id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(receiver_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_high ON conversations(user_high, last_message_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_online ON users(is_online, last_seen)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_likes_post ON likes(post_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_follows_following ON follows(following_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_timelines_post ON timelines(post_id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_comments_post ON comments(post_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_recent ON comments(post_id, created_at, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_post_hashtags_recent ON post_hashtags(created_at, tag)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_post_hashtags_tag ON post_hashtags(tag, created_at, post_id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_shares_post ON shares(post_id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_streams_user ON streams(user_id)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_streams_live ON streams(is_live)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_stream_chat_stream ON stream_chat(stream_id, created_at)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_calls_users ON calls(caller_id, receiver_id)")
         
+        # Full-text search is optional; without FTS5 the rest of the schema still applies
+        try:
+            create_search_index(c, "users", ["username", "display_name", "bio"])
+            create_search_index(c, "posts", ["content"])
+            create_search_index(c, "messages", ["content"])
+            search_ready = True
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable: {str(e)}")
+            search_ready = False
+        
+        # Migrations for databases created by earlier versions
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        ensure_column(c, "users", "profile_pic_hash", "TEXT")
+        ensure_column(c, "posts", "media_hash", "TEXT")
+        ensure_column(c, "posts", "media_size", "INTEGER DEFAULT 0")
+        ensure_column(c, "messages", "thread_key", "TEXT")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_key, created_at, id)")
+        run_migration(c, "media_store_blobs", migrate_media_blobs)
+        run_migration(c, "media_renditions", migrate_media_renditions)
+        run_migration(c, "message_thread_keys", migrate_message_thread_keys)
+        run_migration(c, "conversation_summaries", migrate_conversations)
+        run_migration(c, "post_hashtags", migrate_post_hashtags)
+        if search_ready:
+            run_migration(c, "search_indexes", migrate_search_indexes)
+        run_migration(c, "reconcile_counters", reconcile_counters)
+        run_migration(c, "home_timelines", migrate_timelines)
+        
         conn.commit()
-        return conn
+        return True
     except Exception as e:
         print(f"Database initialization error: {str(e)}")
-        return sqlite3.connect("feedchat.db", check_same_thread=False)
-
-# Initialize database
-conn = init_simple_db()
+        return False
 
 # ===================================
 # WEBRTC VIDEO PROCESSING
 # ===================================
 
-# Global queues for video streaming
-video_frames: Dict[str, queue.Queue] = {}
-audio_frames: Dict[str, queue.Queue] = {}
+# Global stream state
 stream_status: Dict[str, bool] = {}
 active_calls: Dict[str, Dict] = {}
 
+class StreamPresence(BackgroundFlusher):
+    """Live stream viewers tracked with in-memory heartbeats
+
+    Each viewer is a (stream, user) entry stamped with the time of its last
+    heartbeat; entries older than the TTL expire on their own, so viewers who
+    close the tab without pressing Leave drop out of the count. Counts are the
+    size of a stream's entry dict. Joins, leaves and the resulting viewer
+    counts are written to the database in batches by a background thread
+    instead of on every page rerun.
+    """
+
+    thread_name = "StreamPresenceFlusher"
+
+    def __init__(self, pool: ConnectionPool, ttl: float = 30.0, flush_interval: float = 5.0):
+        super().__init__(pool, flush_interval)
+        self.ttl = ttl
+        self._viewers: Dict[str, Dict[int, float]] = {}
+        self._ended: Dict[str, float] = {}
+        self._joined: List[Tuple[str, int]] = []
+        self._left: List[Tuple[str, int]] = []
+        self._dirty: set = set()
+
+    def heartbeat(self, stream_id: str, user_id: int):
+        """Mark a viewer as present, joining the stream if they were not"""
+        with self._lock:
+            if stream_id in self._ended:
+                return
+            viewers = self._viewers.setdefault(stream_id, {})
+            if user_id not in viewers:
+                self._joined.append((stream_id, user_id))
+                self._dirty.add(stream_id)
+            viewers[user_id] = time.time()
+        if self._thread is None:
+            self._start()
+
+    def leave(self, stream_id: str, user_id: int):
+        """Remove a viewer right away"""
+        with self._lock:
+            viewers = self._viewers.get(stream_id)
+            if viewers is not None and viewers.pop(user_id, None) is not None:
+                self._left.append((stream_id, user_id))
+                self._dirty.add(stream_id)
+
+    def count(self, stream_id: str) -> int:
+        """Current number of viewers of a stream"""
+        return len(self._viewers.get(stream_id, ()))
+
+    def end_stream(self, stream_id: str):
+        """Drop every viewer of a stream that has ended
+
+        Late heartbeats for the stream are ignored for a few TTLs, long enough
+        for its viewers' pages and tracks to notice it has ended.
+        """
+        with self._lock:
+            self._ended[stream_id] = time.time()
+            viewers = self._viewers.pop(stream_id, {})
+            self._left.extend((stream_id, user_id) for user_id in viewers)
+            self._dirty.add(stream_id)
+
+    def expire(self):
+        """Drop viewers whose last heartbeat is older than the TTL"""
+        now = time.time()
+        cutoff = now - self.ttl
+        with self._lock:
+            for stream_id, ended_at in list(self._ended.items()):
+                if ended_at < now - self.ttl * 10:
+                    del self._ended[stream_id]
+            for stream_id, viewers in list(self._viewers.items()):
+                for user_id, seen_at in list(viewers.items()):
+                    if seen_at < cutoff:
+                        del viewers[user_id]
+                        self._left.append((stream_id, user_id))
+                        self._dirty.add(stream_id)
+                if not viewers:
+                    del self._viewers[stream_id]
+
+    def tick(self):
+        self.expire()
+        self.flush()
+
+    def flush(self):
+        """Write pending joins, leaves and viewer counts in one transaction"""
+        with self._lock:
+            joined, self._joined = self._joined, []
+            left, self._left = self._left, []
+            counts = [(self.count(stream_id), stream_id) for stream_id in self._dirty]
+            self._dirty = set()
+        
+        if not (joined or left or counts):
+            return
+        
+        try:
+            with self._batch() as c:
+                # stream_viewers.stream_id references streams.id, not the public stream_id
+                c.executemany("""
+                    INSERT INTO stream_viewers (stream_id, user_id)
+                    SELECT id, ? FROM streams WHERE stream_id=? AND is_live=1
+                """, [(user_id, stream_id) for stream_id, user_id in joined])
+                c.executemany("""
+                    UPDATE stream_viewers 
+                    SET left_at=CURRENT_TIMESTAMP 
+                    WHERE stream_id=(SELECT id FROM streams WHERE stream_id=?) 
+                    AND user_id=? AND left_at IS NULL
+                """, left)
+                c.executemany("UPDATE streams SET viewer_count=? WHERE stream_id=?", counts)
+        except Exception:
+            # Put the changes back so the next flush retries them; counts are recomputed then
+            with self._lock:
+                self._joined[:0] = joined
+                self._left[:0] = left
+                self._dirty.update(stream_id for count, stream_id in counts)
+            raise
+
+@st.cache_resource
+def get_stream_presence():
+    """Get the process-wide stream viewer presence service"""
+    return StreamPresence(
+        get_db_pool(),
+        ttl=THEME_CONFIG['live']['presence_ttl_seconds'],
+        flush_interval=THEME_CONFIG['live']['presence_flush_seconds']
+    )
+
+class OverlayEngine:
+    """Composites stacked text banners onto video frames in place
+
+    Each overlay is a horizontal band stacked down from the top of the frame.
+    Only the band rows are touched: they are darkened to 50% with an in-place
+    bit shift, then the text is copied in through a mask limited to the
+    text's bounding box. Text layers are pre-rendered into reusable buffers
+    and rebuilt only when their text or the frame width changes.
+    """
+
+    def __init__(self, band_height: int = 50, font_scale: float = 1.0):
+        self.band_height = band_height
+        self.font_scale = font_scale
+        self._order: List[str] = []
+        self._texts: Dict[str, str] = {}
+        self._layers: Dict[str, Dict[str, Any]] = {}
+
+    def set(self, name: str, text: str):
+        """Add an overlay band or update its text"""
+        if name not in self._texts:
+            self._order.append(name)
+        self._texts[name] = text
+
+    def remove(self, name: str):
+        """Remove an overlay band"""
+        if name in self._texts:
+            self._order.remove(name)
+            del self._texts[name]
+            self._layers.pop(name, None)
+
+    def _layer(self, name: str, width: int) -> Dict[str, Any]:
+        """Get the pre-rendered text layer for a band"""
+        text = self._texts[name]
+        layer = self._layers.get(name)
+        if layer and layer['key'] == (text, width):
+            return layer
+        
+        if layer and layer['pixels'].shape[1] == width:
+            pixels = layer['pixels']
+            pixels.fill(0)
+        else:
+            pixels = np.zeros((self.band_height, width, 3), dtype=np.uint8)
+        baseline = int(self.band_height * 0.7)
+        cv2.putText(pixels, text, (10, baseline), cv2.FONT_HERSHEY_SIMPLEX, self.font_scale,
+                    (255, 255, 255), 2, cv2.LINE_AA)
+        
+        ys, xs = np.nonzero(pixels.any(axis=2))
+        if len(ys):
+            y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        else:
+            y0 = y1 = x0 = x1 = 0
+        text_pixels = pixels[y0:y1, x0:x1]
+        layer = {
+            'key': (text, width),
+            'pixels': pixels,
+            'box': (y0, y1, x0, x1),
+            'text': text_pixels,
+            'mask': text_pixels.any(axis=2).astype(np.uint8) * 255
+        }
+        self._layers[name] = layer
+        return layer
+
+    def apply(self, img: np.ndarray) -> np.ndarray:
+        """Composite all bands onto a BGR frame in place"""
+        height, width = img.shape[:2]
+        y = 0
+        for name in self._order:
+            if y >= height:
+                break
+            rows = min(self.band_height, height - y)
+            roi = img[y:y + rows]
+            np.right_shift(roi, 1, out=roi)
+            
+            layer = self._layer(name, width)
+            y0, y1, x0, x1 = layer['box']
+            y1 = min(y1, rows)
+            if y1 > y0 and x1 > x0:
+                cv2.copyTo(layer['text'][:y1 - y0], layer['mask'][:y1 - y0], roi[y0:y1, x0:x1])
+            y += rows
+        return img
+
+class RelayTrack(MediaStreamTrack):
+    """One viewer's copy of a relayed host track
+
+    Frames are pushed in from the host's processing thread into a small
+    drop-oldest buffer, so a consumer that stops pulling only loses its own
+    stale frames and never holds up the host or other viewers.
+
+    Video tracks also pick a simulcast layer from the share of frames
+    dropped over each check window: heavy dropping steps down a layer right
+    away, while stepping up waits for a clean window that ends with the
+    buffer drained. A clean window only shows that frames are being pulled
+    on time, not that the viewer's link has room for more, so stepping up
+    stops at max_layer: the middle layer unless the viewer picks another.
+
+    While frames are being pulled the track also keeps its viewer's presence
+    alive, so a connected viewer stays counted between page reruns.
+    """
+
+    def __init__(self, relay: "StreamRelay", stream_id: str, kind: str, buffer_size: int = 4,
+                 layers: Optional[List[int]] = None, check_seconds: float = 2.0, max_drop_ratio: float = 0.2,
+                 viewer_id: Optional[int] = None, max_layer: Optional[int] = None):
+        super().__init__()
+        self.kind = kind
+        self.stream_id = stream_id
+        self.viewer_id = viewer_id
+        self._last_heartbeat = 0.0
+        self.layers = sorted(layers or [])
+        default_layer = self.layers[len(self.layers) // 2] if self.layers else None
+        self.max_layer = max_layer or default_layer
+        self.layer = self._cap(default_layer)
+        self.check_seconds = check_seconds
+        self.max_drop_ratio = max_drop_ratio
+        self.dropped = 0
+        self.delivered = 0
+        self._window_start = time.time()
+        self._window_dropped = 0
+        self._window_delivered = 0
+        self._relay = relay
+        self._frames = collections.deque(maxlen=buffer_size)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Event] = None
+
+    def push(self, frame):
+        """Queue a frame for this viewer (called from the host's thread)"""
+        if len(self._frames) == self._frames.maxlen:
+            self.dropped += 1
+            self._window_dropped += 1
+        self._frames.append(frame)
+        self._wake()
+
+    def _wake(self):
+        loop, ready = self._loop, self._ready
+        if loop is not None and ready is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(ready.set)
+
+    def _cap(self, layer: Optional[int]) -> Optional[int]:
+        """The highest layer at or below both layer and max_layer"""
+        if not self.layers:
+            return None
+        allowed = [l for l in self.layers if l <= min(layer, self.max_layer)]
+        return allowed[-1] if allowed else self.layers[0]
+
+    def _select_layer(self, drained: bool):
+        """Move to a lower or higher layer based on the last window's drop ratio"""
+        now = time.time()
+        if not self.layers or now - self._window_start < self.check_seconds:
+            return
+        
+        offered = self._window_delivered + self._window_dropped
+        drop_ratio = self._window_dropped / offered if offered else 0.0
+        index = self.layers.index(self.layer)
+        if drop_ratio > self.max_drop_ratio and index > 0:
+            index -= 1
+        elif drop_ratio == 0 and offered and drained and self.layers[index] < self._cap(self.layers[-1]):
+            index += 1
+        elif drop_ratio == 0 and not drained:
+            return
+        
+        self._window_start = now
+        self._window_dropped = 0
+        self._window_delivered = 0
+        if self.layers[index] != self.layer:
+            self._relay.move(self, self.layers[index])
+
+    def _heartbeat(self):
+        """Refresh the viewer's presence a few times per TTL"""
+        presence = self._relay.presence
+        if presence is None or self.viewer_id is None:
+            return
+        now = time.time()
+        if now - self._last_heartbeat >= presence.ttl / 3:
+            self._last_heartbeat = now
+            presence.heartbeat(self.stream_id, self.viewer_id)
+
+    async def recv(self):
+        """Wait for the next relayed frame"""
+        if self._ready is None:
+            self._loop = asyncio.get_running_loop()
+            self._ready = asyncio.Event()
+        
+        self._select_layer(drained=not self._frames)
+        self._heartbeat()
+        while not self._frames:
+            if self.readyState != "live":
+                raise MediaStreamError
+            self._ready.clear()
+            if self._frames:
+                break
+            await self._ready.wait()
+        
+        if self.readyState != "live":
+            raise MediaStreamError
+        self.delivered += 1
+        self._window_delivered += 1
+        return self._frames.popleft()
+
+    def stop(self):
+        super().stop()
+        self._relay.unsubscribe(self)
+        self._wake()
+
+@dataclass
+class RelayPlayer:
+    """A viewer's relay tracks, shaped like the player webrtc_streamer's player_factory returns"""
+    video: RelayTrack
+    audio: RelayTrack
+
+class StreamRelay:
+    """Fans decoded host frames out to every viewer of a stream
+
+    The host's processor publishes each frame once per simulcast layer that
+    has viewers; every RelayTrack on that layer receives the same frame
+    object, so the source is decoded and scaled once no matter how many
+    viewers are watching. Subscribers are held weakly and disappear with the
+    viewer's session.
+    """
+
+    def __init__(self, buffer_size: int = 4, layers: Optional[List[int]] = None, check_seconds: float = 2.0,
+                 presence: Optional[StreamPresence] = None):
+        self.buffer_size = buffer_size
+        self.presence = presence
+        self.layers = sorted(layers or [])
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._subscribers: Dict[Tuple[str, str, Optional[int]], "weakref.WeakSet[RelayTrack]"] = {}
+
+    def subscribe(self, stream_id: str, kind: str, viewer_id: Optional[int] = None,
+                  max_layer: Optional[int] = None) -> RelayTrack:
+        """Create a viewer track for a stream's audio or video"""
+        track = RelayTrack(
+            self, stream_id, kind, self.buffer_size,
+            layers=self.layers if kind == "video" else None,
+            check_seconds=self.check_seconds,
+            viewer_id=viewer_id,
+            max_layer=max_layer
+        )
+        with self._lock:
+            self._subscribers.setdefault((stream_id, kind, track.layer), weakref.WeakSet()).add(track)
+        return track
+
+    def player(self, stream_id: str, viewer_id: Optional[int] = None,
+               max_layer: Optional[int] = None) -> RelayPlayer:
+        """Create the video and audio tracks for one viewer's WebRTC session"""
+        return RelayPlayer(
+            video=self.subscribe(stream_id, "video", viewer_id=viewer_id, max_layer=max_layer),
+            audio=self.subscribe(stream_id, "audio", viewer_id=viewer_id)
+        )
+
+    def unsubscribe(self, track: RelayTrack):
+        """Stop delivering frames to a viewer track"""
+        with self._lock:
+            subscribers = self._subscribers.get((track.stream_id, track.kind, track.layer))
+            if subscribers is not None:
+                subscribers.discard(track)
+
+    def move(self, track: RelayTrack, layer: int):
+        """Switch a viewer track to another simulcast layer"""
+        with self._lock:
+            subscribers = self._subscribers.get((track.stream_id, track.kind, track.layer))
+            if subscribers is not None:
+                subscribers.discard(track)
+            track.layer = layer
+            if track.readyState == "live":
+                self._subscribers.setdefault((track.stream_id, track.kind, layer), weakref.WeakSet()).add(track)
+
+    def active_layers(self, stream_id: str) -> List[int]:
+        """Simulcast layers of a stream that currently have viewers"""
+        return [layer for layer in self.layers if self._subscribers.get((stream_id, "video", layer))]
+
+    def publish(self, stream_id: str, kind: str, frame, layer: Optional[int] = None):
+        """Deliver a host frame to every viewer of the stream on a layer"""
+        subscribers = self._subscribers.get((stream_id, kind, layer))
+        if not subscribers:
+            return
+        with self._lock:
+            tracks = list(subscribers)
+        for track in tracks:
+            track.push(frame)
+
+    def subscriber_count(self, stream_id: str, kind: str = "video") -> int:
+        """Number of connected viewer tracks"""
+        layers = self.layers if kind == "video" and self.layers else [None]
+        return sum(len(self._subscribers.get((stream_id, kind, layer), ())) for layer in layers)
+
+    def _viewer_tracks(self, stream_id: str, viewer_id: int, kind: Optional[str] = None) -> List[RelayTrack]:
+        with self._lock:
+            return [track for key, subscribers in self._subscribers.items()
+                    if key[0] == stream_id and kind in (None, key[1])
+                    for track in subscribers if track.viewer_id == viewer_id]
+
+    def set_max_layer(self, stream_id: str, viewer_id: int, max_layer: Optional[int] = None):
+        """Change the highest layer a viewer's video may use, None for the default"""
+        if not self.layers:
+            return
+        for track in self._viewer_tracks(stream_id, viewer_id, "video"):
+            track.max_layer = max_layer or self.layers[len(self.layers) // 2]
+            if track.layer > track.max_layer:
+                self.move(track, track._cap(track.layer))
+
+    def stop_viewer(self, stream_id: str, viewer_id: int):
+        """Stop every track a viewer has open on a stream"""
+        for track in self._viewer_tracks(stream_id, viewer_id):
+            track.stop()
+
+    def close(self, stream_id: str):
+        """End a stream for all of its viewers"""
+        with self._lock:
+            tracks = []
+            for key in [key for key in self._subscribers if key[0] == stream_id]:
+                tracks.extend(self._subscribers.pop(key))
+        for track in tracks:
+            track.stop()
+
+@st.cache_resource
+def get_stream_relay():
+    """Get the process-wide live stream relay"""
+    return StreamRelay(
+        buffer_size=THEME_CONFIG['live']['viewer_buffer_frames'],
+        layers=THEME_CONFIG['live']['simulcast_layers'],
+        check_seconds=THEME_CONFIG['live']['layer_check_seconds'],
+        presence=get_stream_presence()
+    )
+
 class VideoProcessor:
-    def __init__(self, stream_id: str, is_host: bool = False):
+    def __init__(self, stream_id: str, is_host: bool = False, presence: Optional[StreamPresence] = None,
+                 title: str = "", relay: Optional[StreamRelay] = None):
         self.stream_id = stream_id
         self.is_host = is_host
-        self.frames_queue = queue.Queue(maxsize=10)
+        self.presence = presence
+        self.relay = relay
+        self.overlay = OverlayEngine()
+        if title:
+            self.overlay.set("title", title)
         
     def recv(self, frame: av.VideoFrame) -> av.VideoFrame:
         """Process incoming video frame"""
         img = frame.to_ndarray(format="bgr24")
         
-        # Add overlay for host
-        if self.is_host:
-            # Add viewer count overlay
-            viewer_count = get_stream_viewer_count(self.stream_id)
-            img = self.add_overlay(img, f"Viewers: {viewer_count}")
+        # Add overlays for host
+        if self.is_host and self.presence is not None:
+            # Viewer count comes from in-memory presence, not the database
+            viewer_count = self.presence.count(self.stream_id)
+            self.overlay.set("viewers", f"Viewers: {viewer_count}")
+            self.overlay.apply(img)
         
-        # Store frame in global queue
-        if self.stream_id not in video_frames:
-            video_frames[self.stream_id] = queue.Queue(maxsize=10)
+        new_frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame.pts = frame.pts
+        new_frame.time_base = frame.time_base
         
-        try:
-            if video_frames[self.stream_id].qsize() < 5:
-                video_frames[self.stream_id].put_nowait(img)
-        except queue.Full:
-            pass
+        # Fan the processed frame out to viewers, one scaled copy per watched layer
+        if self.is_host and self.relay is not None:
+            self.publish_layers(img, new_frame)
         
-        return av.VideoFrame.from_ndarray(img, format="bgr24")
+        return new_frame
     
-    def add_overlay(self, img: np.ndarray, text: str) -> np.ndarray:
-        """Add text overlay to video frame"""
-        height, width = img.shape[:2]
-        
-        # Add semi-transparent overlay at top
-        overlay = img.copy()
-        cv2.rectangle(overlay, (0, 0), (width, 50), (0, 0, 0), -1)
-        cv2.addWeighted(overlay, 0.5, img, 0.5, 0, img)
-        
-        # Add text
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        cv2.putText(img, text, (10, 35), font, 1, (255, 255, 255), 2, cv2.LINE_AA)
+    def publish_layers(self, img: np.ndarray, source_frame: av.VideoFrame):
+        """Scale the frame once for each simulcast layer that has viewers"""
+        if not self.relay.layers:
+            self.relay.publish(self.stream_id, "video", source_frame)
+            return
         
-        return img
+        height, width = img.shape[:2]
+        for layer in self.relay.active_layers(self.stream_id):
+            if layer >= height:
+                layer_frame = source_frame
+            else:
+                # Keep the aspect ratio and even dimensions for the encoder
+                layer_width = max(2, int(round(width * layer / height / 2)) * 2)
+                scaled = cv2.resize(img, (layer_width, layer), interpolation=cv2.INTER_AREA)
+                layer_frame = av.VideoFrame.from_ndarray(scaled, format="bgr24")
+                layer_frame.pts = source_frame.pts
+                layer_frame.time_base = source_frame.time_base
+            self.relay.publish(self.stream_id, "video", layer_frame, layer=layer)
 
 class AudioProcessor:
-    def __init__(self, stream_id: str):
+    def __init__(self, stream_id: str, is_host: bool = False, relay: Optional[StreamRelay] = None):
         self.stream_id = stream_id
+        self.is_host = is_host
+        self.relay = relay
         
     def recv(self, frame: av.AudioFrame) -> av.AudioFrame:
         """Process incoming audio frame"""
-        # Store audio frame for viewers
-        if self.stream_id not in audio_frames:
-            audio_frames[self.stream_id] = queue.Queue(maxsize=20)
-        
-        try:
-            if audio_frames[self.stream_id].qsize() < 10:
-                audio_frames[self.stream_id].put_nowait(frame)
-        except queue.Full:
-            pass
+        # Fan audio out to viewers
+        if self.is_host and self.relay is not None:
+            self.relay.publish(self.stream_id, "audio", frame)
         
         return frame
 
+# ===================================
+# CACHES
+# ===================================
+
+class TTLCache:
+    """Thread-safe in-memory cache whose entries expire after a fixed time
+
+    Least recently used entries are evicted once max_entries is reached.
+    Writers call invalidate() for keys whose source rows they change.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "collections.OrderedDict[Any, Tuple[float, Any]]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a cached value, or default if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache a value for ttl seconds"""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Drop cached values so the next read goes to the database"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource
+def get_user_cache():
+    """Get the process-wide cache of user records, keyed by user id"""
+    return TTLCache(THEME_CONFIG['cache']['user_ttl_seconds'], THEME_CONFIG['cache']['user_max_entries'])
+
+def invalidate_user(*user_ids):
+    """Forget cached records of users whose row changed"""
+    get_user_cache().invalidate(*user_ids)
+
+@st.cache_resource
+def get_share_target_cache():
+    """Get the process-wide cache of share targets, keyed by viewer id"""
+    return TTLCache(THEME_CONFIG['cache']['share_targets_ttl_seconds'], THEME_CONFIG['cache']['user_max_entries'])
+
+# ===================================
+# EVENT BUS
+# ===================================
+
+class Subscription:
+    """One subscriber's bounded queue of events from the topics it follows
+
+    When the queue is full the oldest event is dropped and counted, so a
+    subscriber that fell behind knows to reload instead of trusting events.
+    """
+
+    def __init__(self, topics: Tuple[tuple, ...], queue_size: int = 100):
+        self.topics = topics
+        self._events = collections.deque(maxlen=queue_size)
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, event: Dict[str, Any]):
+        with self._lock:
+            if len(self._events) == self._events.maxlen:
+                self._dropped += 1
+            self._events.append(event)
+
+    def poll(self) -> Tuple[List[Dict[str, Any]], int]:
+        """Take the queued events and the number dropped since the last poll"""
+        with self._lock:
+            events, dropped = list(self._events), self._dropped
+            self._events.clear()
+            self._dropped = 0
+        return events, dropped
+
+class EventBus:
+    """Thread-safe in-process publish/subscribe keyed by topic
+
+    Topics are tuples such as ("user", user_id), ("stream", stream_id) or
+    ("call", call_id). Subscriptions are held weakly, so one dropped along
+    with its session's state stops receiving events on its own.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: Dict[tuple, "weakref.WeakSet[Subscription]"] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, *topics: tuple) -> Subscription:
+        subscription = Subscription(topics, self.queue_size)
+        with self._lock:
+            for topic in topics:
+                self._subscribers.setdefault(topic, weakref.WeakSet()).add(subscription)
+        return subscription
+
+    def publish(self, topic: tuple, event: Dict[str, Any]):
+        """Queue an event for every current subscriber of topic"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+            if not subscribers:
+                self._subscribers.pop(topic, None)
+        for subscription in subscribers:
+            subscription.put(event)
+
+@st.cache_resource
+def get_event_bus():
+    """Get the process-wide event bus"""
+    return EventBus(THEME_CONFIG['events']['queue_size'])
+
+def events_changed(name, topic, match=None):
+    """Whether a panel fed by topic should reload from the database
+
+    The session subscribes under name on first use, which counts as a change.
+    After that only a matching event, an overflowed queue or the periodic
+    resync (for writes this process never saw) report a change.
+    """
+    subscriptions = st.session_state.setdefault('event_subscriptions', {})
+    entry = subscriptions.get(name)
+    now = time.time()
+    if entry is None or entry['subscription'].topics != (topic,):
+        subscriptions[name] = {'subscription': get_event_bus().subscribe(topic), 'synced_at': now}
+        return True
+    
+    events, dropped = entry['subscription'].poll()
+    if (dropped or any(match is None or match(event) for event in events)
+            or now - entry['synced_at'] >= THEME_CONFIG['events']['resync_seconds']):
+        entry['synced_at'] = now
+        return True
+    return False
+
 # ===================================
 # CORE FUNCTIONS
 # ===================================
 
+def extract_hashtags(text):
+    """Extract up to 10 distinct lowercase hashtags in order of appearance"""
+    hashtags = dict.fromkeys(tag.lower() for tag in re.findall(r'#(\w+)', text or ""))
+    return list(hashtags)[:10]
+
 def extract_hashtags_string(text):
     """Extract hashtags and return as comma-separated string"""
-    hashtags = re.findall(r'#(\w+)', text)
-    return ','.join(list(set(hashtags))[:10])
+    return ','.join(extract_hashtags(text))
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching every word as a prefix
+
+    Words are quoted, so user input can never be parsed as FTS syntax.
+    Returns None when there is nothing to search for.
+    """
+    words = re.findall(r'[^\W_]+', text or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words[:8])
 
 def format_tiktok_time(timestamp):
     """Format timestamp in TikTok style"""
@@ -516,34 +1799,160 @@ def create_default_profile_pic(username):
 # USER MANAGEMENT FUNCTIONS
 # ===================================
 
+# SQL for the oldest last_seen that still counts as online
+ONLINE_CUTOFF = f"datetime('now', '-{int(THEME_CONFIG['presence']['online_ttl_seconds'])} seconds')"
+
+class OnlinePresence(BackgroundFlusher):
+    """Throttled online heartbeats for signed-in users
+
+    Every rerun records the user's last-seen time in memory. The first
+    heartbeat is written straight away; after that a background thread
+    writes the latest last_seen for each active user at most once per write
+    interval, writes it one final time before forgetting an idle user, and
+    sweeps users whose last_seen is older than the TTL to offline, which
+    covers sessions that end by closing the tab. Readers also check
+    last_seen against the TTL, so a user shows offline as soon as it lapses,
+    before the next sweep.
+    """
+
+    thread_name = "OnlinePresenceSweeper"
+
+    def __init__(self, pool: ConnectionPool, ttl: float = 120, write_interval: float = 60,
+                 sweep_interval: float = 15):
+        super().__init__(pool, sweep_interval)
+        self.ttl = ttl
+        self.write_interval = write_interval
+        self._last_seen: Dict[int, float] = {}
+        self._last_written: Dict[int, float] = {}
+
+    def touch(self, user_id: int):
+        """Record activity by a user, writing it at once if they were not yet tracked"""
+        now = time.time()
+        with self._lock:
+            first = user_id not in self._last_seen
+            self._last_seen[user_id] = now
+            if first:
+                self._last_written[user_id] = now
+        if first:
+            try:
+                self._write([(now, user_id)])
+            except Exception:
+                with self._lock:
+                    if self._last_written.get(user_id) == now:
+                        self._last_written.pop(user_id, None)
+                raise
+        if self._thread is None:
+            self._start()
+
+    def leave(self, user_id: int):
+        """Mark a user offline right away (on logout)"""
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+            self._last_written.pop(user_id, None)
+        conn = self.pool.connection()
+        conn.execute("UPDATE users SET is_online=0, last_seen=CURRENT_TIMESTAMP WHERE id=?", (user_id,))
+
+    def tick(self):
+        self.flush()
+        self.sweep()
+
+    def flush(self):
+        """Write the latest last_seen for users due a refresh, then forget idle users"""
+        now = time.time()
+        with self._lock:
+            previous = {}
+            due = []
+            for user_id, seen_at in list(self._last_seen.items()):
+                written_at = self._last_written.get(user_id, 0)
+                if seen_at > written_at and (now - written_at >= self.write_interval
+                                             or now - seen_at >= self.ttl):
+                    previous[user_id] = self._last_written.get(user_id)
+                    self._last_written[user_id] = seen_at
+                    due.append((seen_at, user_id))
+        
+        if due:
+            try:
+                self._write(due)
+            except Exception:
+                # Restore the old write times so the next flush retries these users
+                with self._lock:
+                    for seen_at, user_id in due:
+                        if self._last_written.get(user_id) != seen_at:
+                            continue
+                        if previous[user_id] is None:
+                            self._last_written.pop(user_id, None)
+                        else:
+                            self._last_written[user_id] = previous[user_id]
+                raise
+        
+        # Only forget users whose final last_seen has been written
+        with self._lock:
+            for user_id, seen_at in list(self._last_seen.items()):
+                if now - seen_at >= self.ttl and self._last_written.get(user_id) == seen_at:
+                    self._last_seen.pop(user_id, None)
+                    self._last_written.pop(user_id, None)
+
+    def _write(self, rows: List[tuple]):
+        with self._batch() as c:
+            c.executemany("""
+                UPDATE users SET is_online=1, last_seen=datetime(?, 'unixepoch') WHERE id=?
+            """, rows)
+
+    def sweep(self):
+        """Mark users offline once their last_seen is older than the TTL"""
+        conn = self.pool.connection()
+        conn.execute(f"UPDATE users SET is_online=0 WHERE is_online=1 AND last_seen < {ONLINE_CUTOFF}")
+
+@st.cache_resource
+def get_online_presence():
+    """Get the process-wide online presence tracker"""
+    return OnlinePresence(
+        get_db_pool(),
+        ttl=THEME_CONFIG['presence']['online_ttl_seconds'],
+        write_interval=THEME_CONFIG['presence']['write_interval_seconds'],
+        sweep_interval=THEME_CONFIG['presence']['sweep_interval_seconds']
+    )
+
 def update_user_online_status(user_id, is_online=True):
-    """Update user online status"""
+    """Record a heartbeat for a user, or mark them offline"""
     try:
-        c = conn.cursor()
-        c.execute("UPDATE users SET is_online=?, last_seen=CURRENT_TIMESTAMP WHERE id=?", 
-                 (1 if is_online else 0, user_id))
-        conn.commit()
+        presence = get_online_presence()
+        if is_online:
+            presence.touch(user_id)
+        else:
+            presence.leave(user_id)
+            invalidate_user(user_id)
         return True
     except:
         return False
 
 def get_user(user_id):
-    """Get user data"""
+    """Get user data, served from the user cache for up to its TTL"""
+    cache = get_user_cache()
+    user = cache.get(user_id)
+    if user is not None:
+        return user
+    
     try:
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute("""
-            SELECT id, username, display_name, email, profile_pic, bio, location, 
-                   timezone, language, is_online, last_seen, created_at, post_count, 
+        c.execute(f"""
+            SELECT id, username, display_name, email, profile_pic_hash, bio, location, 
+                   timezone, language, (is_online AND last_seen >= {ONLINE_CUTOFF}) AS is_online, last_seen, created_at, post_count, 
                    follower_count, following_count, total_likes, verified, is_live, current_stream_id
             FROM users WHERE id=?
         """, (user_id,))
-        return c.fetchone()
+        user = c.fetchone()
+        if user is not None:
+            cache.set(user_id, user)
+        return user
     except:
         return None
 
 def update_user_profile(user_id, display_name=None, bio=None, location=None, profile_pic=None):
     """Update user profile information"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
         updates = []
@@ -562,14 +1971,17 @@ def update_user_profile(user_id, display_name=None, bio=None, location=None, pro
             params.append(location)
         
         if profile_pic is not None:
-            updates.append("profile_pic = ?")
-            params.append(profile_pic)
+            profile_pic_hash = store_media(profile_pic)
+            create_renditions(profile_pic_hash, 'avatar')
+            updates.append("profile_pic_hash = ?")
+            params.append(profile_pic_hash)
         
         if updates:
             params.append(user_id)
             query = f"UPDATE users SET {', '.join(updates)} WHERE id = ?"
             c.execute(query, params)
             conn.commit()
+            invalidate_user(user_id)
             return True
         return False
     except Exception as e:
@@ -583,6 +1995,7 @@ def hash_password(password):
 def verify_user_secure(username, password):
     """Enhanced user verification"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
             SELECT id, username, password_hash 
@@ -605,6 +2018,7 @@ def verify_user_secure(username, password):
 def create_user_secure(username, password, email, display_name=None, profile_pic=None):
     """Create user with secure password hashing"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
         # Check if user exists
@@ -625,10 +2039,13 @@ def create_user_secure(username, password, email, display_name=None, profile_pic
         if not profile_pic:
             profile_pic = create_default_profile_pic(username)
         
+        profile_pic_hash = store_media(profile_pic)
+        create_renditions(profile_pic_hash, 'avatar')
+        
         c.execute("""
-            INSERT INTO users (username, display_name, password_hash, email, profile_pic) 
+            INSERT INTO users (username, display_name, password_hash, email, profile_pic_hash) 
             VALUES (?, ?, ?, ?, ?)
-        """, (username, display_name, password_hash, email, profile_pic))
+        """, (username, display_name, password_hash, email, profile_pic_hash))
         
         conn.commit()
         return True, "Account created successfully"
@@ -638,17 +2055,35 @@ def create_user_secure(username, password, email, display_name=None, profile_pic
 def get_global_users(search_term=None, limit=50):
     """Get global users with filtering"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
-        query = "SELECT id, username, profile_pic, bio, location, language, is_online, is_live FROM users WHERE id != ?"
-        params = [st.session_state.get('user_id', 0)]
-        
-        if search_term:
-            query += " AND (username LIKE ? OR bio LIKE ?)"
-            params.extend([f'%{search_term}%', f'%{search_term}%'])
-        
-        query += " ORDER BY is_online DESC, is_live DESC, username ASC LIMIT ?"
-        params.append(limit)
+        match = fts_query(search_term)
+        if match and search_index_exists("users_fts"):
+            # Ranked by BM25, with username matches weighted above display name and bio
+            query = f"""
+                SELECT u.id, u.username, u.profile_pic_hash, u.bio, u.location, u.language,
+                    (u.is_online AND u.last_seen >= {ONLINE_CUTOFF}) AS is_online, u.is_live
+                FROM users_fts
+                JOIN users u ON u.id = users_fts.rowid
+                WHERE users_fts MATCH ? AND u.id != ?
+                ORDER BY bm25(users_fts, 10.0, 5.0, 1.0)
+                LIMIT ?
+            """
+            params = [match, st.session_state.get('user_id', 0), limit]
+        else:
+            query = f"""
+                SELECT id, username, profile_pic_hash, bio, location, language,
+                    (is_online AND last_seen >= {ONLINE_CUTOFF}) AS is_online, is_live FROM users WHERE id != ?
+            """
+            params = [st.session_state.get('user_id', 0)]
+            
+            if search_term:
+                query += " AND (username LIKE ? OR display_name LIKE ? OR bio LIKE ?)"
+                params.extend([f'%{search_term}%'] * 3)
+            
+            query += " ORDER BY is_online DESC, is_live DESC, username ASC LIMIT ?"
+            params.append(limit)
         
         c.execute(query, params)
         return c.fetchall()
@@ -666,6 +2101,7 @@ def generate_stream_key():
 def start_stream(user_id, title="", description=""):
     """Start a new live stream"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         stream_id = str(uuid.uuid4())
         stream_key = generate_stream_key()
@@ -679,10 +2115,8 @@ def start_stream(user_id, title="", description=""):
         c.execute("UPDATE users SET is_live=1, current_stream_id=? WHERE id=?", (stream_id, user_id))
         
         conn.commit()
+        invalidate_user(user_id)
         
-        # Initialize video queue for this stream
-        video_frames[stream_id] = queue.Queue(maxsize=10)
-        audio_frames[stream_id] = queue.Queue(maxsize=20)
         stream_status[stream_id] = True
         
         return True, stream_id, stream_key
@@ -692,6 +2126,7 @@ def start_stream(user_id, title="", description=""):
 def end_stream(stream_id):
     """End a live stream"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
         # Get user_id from stream
@@ -712,12 +2147,12 @@ def end_stream(stream_id):
             c.execute("UPDATE users SET is_live=0, current_stream_id=NULL WHERE id=?", (user_id,))
             
             conn.commit()
+            invalidate_user(user_id)
             
-            # Clean up queues
-            if stream_id in video_frames:
-                del video_frames[stream_id]
-            if stream_id in audio_frames:
-                del audio_frames[stream_id]
+            # Disconnect viewers
+            get_stream_relay().close(stream_id)
+            get_stream_presence().end_stream(stream_id)
+            get_stream_chat().end_stream(stream_id)
             if stream_id in stream_status:
                 del stream_status[stream_id]
         
@@ -728,9 +2163,10 @@ def end_stream(stream_id):
 def get_live_streams():
     """Get all currently live streams"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
-            SELECT s.*, u.username, u.display_name, u.profile_pic 
+            SELECT s.*, u.username, u.display_name, u.profile_pic_hash 
             FROM streams s
             JOIN users u ON s.user_id = u.id
             WHERE s.is_live=1
@@ -743,9 +2179,10 @@ def get_live_streams():
 def get_stream(stream_id):
     """Get stream details"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
-            SELECT s.*, u.username, u.display_name, u.profile_pic 
+            SELECT s.*, u.username, u.display_name, u.profile_pic_hash 
             FROM streams s
             JOIN users u ON s.user_id = u.id
             WHERE s.stream_id=?
@@ -755,27 +2192,9 @@ def get_stream(stream_id):
         return None
 
 def add_stream_viewer(stream_id, user_id):
-    """Add viewer to stream"""
+    """Record a viewer heartbeat for a stream"""
     try:
-        c = conn.cursor()
-        
-        # Add to viewers table
-        c.execute("""
-            INSERT INTO stream_viewers (stream_id, user_id)
-            VALUES (?, ?)
-        """, (stream_id, user_id))
-        
-        # Update viewer count
-        c.execute("""
-            UPDATE streams 
-            SET viewer_count = (
-                SELECT COUNT(*) FROM stream_viewers 
-                WHERE stream_id=? AND left_at IS NULL
-            )
-            WHERE stream_id=?
-        """, (stream_id, stream_id))
-        
-        conn.commit()
+        get_stream_presence().heartbeat(stream_id, user_id)
         return True
     except:
         return False
@@ -783,26 +2202,7 @@ def add_stream_viewer(stream_id, user_id):
 def remove_stream_viewer(stream_id, user_id):
     """Remove viewer from stream"""
     try:
-        c = conn.cursor()
-        
-        # Update viewer record
-        c.execute("""
-            UPDATE stream_viewers 
-            SET left_at=CURRENT_TIMESTAMP 
-            WHERE stream_id=? AND user_id=? AND left_at IS NULL
-        """, (stream_id, user_id))
-        
-        # Update viewer count
-        c.execute("""
-            UPDATE streams 
-            SET viewer_count = (
-                SELECT COUNT(*) FROM stream_viewers 
-                WHERE stream_id=? AND left_at IS NULL
-            )
-            WHERE stream_id=?
-        """, (stream_id, stream_id))
-        
-        conn.commit()
+        get_stream_presence().leave(stream_id, user_id)
         return True
     except:
         return False
@@ -810,39 +2210,187 @@ def remove_stream_viewer(stream_id, user_id):
 def get_stream_viewer_count(stream_id):
     """Get current viewer count for stream"""
     try:
-        c = conn.cursor()
-        c.execute("SELECT viewer_count FROM streams WHERE stream_id=?", (stream_id,))
-        result = c.fetchone()
-        return result[0] if result else 0
+        return get_stream_presence().count(stream_id)
     except:
         return 0
 
+class StreamChatBuffer(BackgroundFlusher):
+    """Recent stream chat kept in a bounded ring per live stream
+
+    Viewers read new messages from memory with an after_id cursor instead of
+    querying stream_chat joined with users on every refresh. A ring is
+    loaded from the database the first time its live stream is touched.
+    New messages take their ids from the table's AUTOINCREMENT sequence and
+    are written back in batches by a background thread.
+    """
+
+    INSERT_SQL = """
+        INSERT INTO stream_chat (id, stream_id, user_id, message, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """
+
+    thread_name = "StreamChatFlusher"
+
+    def __init__(self, pool: ConnectionPool, size: int = 200, flush_interval: float = 1.0,
+                 max_retries: int = 5):
+        super().__init__(pool, flush_interval)
+        self.size = size
+        self.max_retries = max_retries
+        self._rings: Dict[str, Tuple[int, "collections.deque[tuple]"]] = {}
+        self._pending: List[Tuple[tuple, int]] = []
+        self._last_id: Optional[int] = None
+
+    def _load(self, stream_id: str, limit: int) -> List[tuple]:
+        """Newest stored messages of a stream, oldest first"""
+        c = self.pool.connection().cursor()
+        c.execute("""
+            SELECT sc.*, u.username, u.profile_pic_hash
+            FROM stream_chat sc
+            JOIN users u ON sc.user_id = u.id
+            WHERE sc.stream_id = (SELECT id FROM streams WHERE stream_id = ?)
+            ORDER BY sc.created_at DESC, sc.id DESC
+            LIMIT ?
+        """, (stream_id, limit))
+        return c.fetchall()[::-1]
+
+    def _ring(self, stream_id: str) -> Optional[Tuple[int, "collections.deque[tuple]"]]:
+        """(streams.id, ring) of a live stream, or None if it is not live"""
+        with self._lock:
+            entry = self._rings.get(stream_id)
+        if entry is not None:
+            return entry
+        
+        # Load outside the lock; if two threads race, the first ring stored wins
+        c = self.pool.connection().cursor()
+        c.execute("SELECT id FROM streams WHERE stream_id = ? AND is_live = 1", (stream_id,))
+        result = c.fetchone()
+        if result is None:
+            return None
+        ring = collections.deque(self._load(stream_id, self.size), maxlen=self.size)
+        with self._lock:
+            return self._rings.setdefault(stream_id, (result[0], ring))
+
+    def _seed_ids(self):
+        """Move the id counter past every id the table has handed out"""
+        c = self.pool.connection().cursor()
+        c.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'stream_chat'")
+        seq = c.fetchone()[0]
+        with self._lock:
+            self._last_id = max(self._last_id or 0, seq)
+
+    def post(self, stream_id: str, user_id: int, message: str) -> Optional[int]:
+        """Add a message to a live stream's chat; returns its id"""
+        user = get_user(user_id)
+        entry = self._ring(stream_id)
+        if user is None or entry is None:
+            return None
+        if self._last_id is None:
+            self._seed_ids()
+        
+        stream_row, ring = entry
+        with self._lock:
+            self._last_id += 1
+            row = (self._last_id, stream_row, user_id, message, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+                   user[1], user[4])
+            ring.append(row)
+            self._pending.append((row[:5], 0))
+        if self._thread is None:
+            self._start()
+        return row[0]
+
+    def recent(self, stream_id: str, limit: int = 50, after_id: Optional[int] = None) -> List[tuple]:
+        """Newest messages of a stream first, only those after after_id if given
+
+        Streams that are not live are read from the database without caching.
+        """
+        entry = self._ring(stream_id)
+        if entry is None:
+            rows = self._load(stream_id, limit)
+        else:
+            with self._lock:
+                rows = list(entry[1])
+        return [row for row in reversed(rows) if after_id is None or row[0] > after_id][:limit]
+
+    def end_stream(self, stream_id: str):
+        """Drop an ended stream's ring; its unwritten messages are still flushed"""
+        with self._lock:
+            self._rings.pop(stream_id, None)
+
+    def flush(self):
+        """Write buffered messages to stream_chat
+
+        The batch goes in one transaction. If that fails, rows are retried one
+        at a time so a bad row cannot hold back the rest: rows that break a
+        constraint are dropped, other failures are retried on later flushes
+        up to max_retries times.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        
+        try:
+            with self._batch() as c:
+                c.executemany(self.INSERT_SQL, [row for row, attempts in pending])
+            return
+        except Exception:
+            pass
+        
+        c = self.pool.connection().cursor()
+        retry = []
+        for row, attempts in pending:
+            try:
+                self._insert_one(c, row)
+            except sqlite3.IntegrityError as e:
+                print(f"Dropping stream chat message {row[0]}: {e}")
+            except Exception as e:
+                if attempts + 1 >= self.max_retries:
+                    print(f"Dropping stream chat message {row[0]} after {attempts + 1} attempts: {e}")
+                else:
+                    retry.append((row, attempts + 1))
+        if retry:
+            with self._lock:
+                self._pending[:0] = retry
+
+    def _insert_one(self, c, row: tuple):
+        """Insert one message, letting SQLite pick a new id if its id is taken"""
+        try:
+            c.execute(self.INSERT_SQL, row)
+        except sqlite3.IntegrityError:
+            c.execute("SELECT 1 FROM stream_chat WHERE id = ?", (row[0],))
+            if c.fetchone() is None:
+                raise
+            # Another writer used this id; the ring keeps the old one as its cursor
+            c.execute("""
+                INSERT INTO stream_chat (stream_id, user_id, message, created_at)
+                VALUES (?, ?, ?, ?)
+            """, row[1:])
+            self._seed_ids()
+
+@st.cache_resource
+def get_stream_chat():
+    """Get the process-wide stream chat buffer"""
+    return StreamChatBuffer(get_db_pool(), size=THEME_CONFIG['live']['chat_buffer_size'],
+                            flush_interval=THEME_CONFIG['live']['chat_flush_seconds'])
+
 def send_stream_message(stream_id, user_id, message):
     """Send message in stream chat"""
     try:
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO stream_chat (stream_id, user_id, message)
-            VALUES (?, ?, ?)
-        """, (stream_id, user_id, message))
-        conn.commit()
+        message_id = get_stream_chat().post(stream_id, user_id, message)
+        if message_id is None:
+            return False
+        get_event_bus().publish(("stream", stream_id), {"type": "chat", "message_id": message_id})
         return True
     except:
         return False
 
-def get_stream_messages(stream_id, limit=50):
-    """Get stream chat messages"""
+def get_stream_messages(stream_id, limit=50, after_id=None):
+    """Get stream chat messages, newest first
+
+    after_id returns only the messages newer than one already shown.
+    """
     try:
-        c = conn.cursor()
-        c.execute("""
-            SELECT sc.*, u.username, u.profile_pic
-            FROM stream_chat sc
-            JOIN users u ON sc.user_id = u.id
-            WHERE sc.stream_id=?
-            ORDER BY sc.created_at DESC
-            LIMIT ?
-        """, (stream_id, limit))
-        return c.fetchall()
+        return get_stream_chat().recent(stream_id, limit, after_id)
     except:
         return []
 
@@ -850,9 +2398,20 @@ def get_stream_messages(stream_id, limit=50):
 # VIDEO CALL FUNCTIONS
 # ===================================
 
+def publish_call_event(call_id, status):
+    """Tell the call's watchers and both parties that it changed state"""
+    event = {"type": "call", "call_id": call_id, "status": status}
+    bus = get_event_bus()
+    bus.publish(("call", call_id), event)
+    call = active_calls.get(call_id)
+    if call:
+        bus.publish(("user", call['caller_id']), event)
+        bus.publish(("user", call['receiver_id']), event)
+
 def initiate_call(caller_id, receiver_id, call_type='video'):
     """Initiate a call between users"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         call_id = str(uuid.uuid4())
         
@@ -871,6 +2430,7 @@ def initiate_call(caller_id, receiver_id, call_type='video'):
             'status': 'initiated',
             'started_at': time.time()
         }
+        publish_call_event(call_id, 'initiated')
         
         return True, call_id
     except Exception as e:
@@ -879,6 +2439,7 @@ def initiate_call(caller_id, receiver_id, call_type='video'):
 def accept_call(call_id):
     """Accept an incoming call"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
         c.execute("""
@@ -891,6 +2452,7 @@ def accept_call(call_id):
         
         if call_id in active_calls:
             active_calls[call_id]['status'] = 'active'
+        publish_call_event(call_id, 'active')
         
         return True
     except:
@@ -899,6 +2461,7 @@ def accept_call(call_id):
 def end_call(call_id):
     """End an active call"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
         # Calculate duration
@@ -916,15 +2479,10 @@ def end_call(call_id):
         conn.commit()
         
         # Remove from active calls
+        publish_call_event(call_id, 'ended')
         if call_id in active_calls:
             del active_calls[call_id]
         
-        # Clean up video/audio queues
-        if call_id in video_frames:
-            del video_frames[call_id]
-        if call_id in audio_frames:
-            del audio_frames[call_id]
-        
         return True
     except:
         return False
@@ -932,6 +2490,7 @@ def end_call(call_id):
 def get_active_call(user_id):
     """Get active call for user"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
             SELECT * FROM calls 
@@ -946,6 +2505,7 @@ def get_active_call(user_id):
 def get_call_messages(call_id):
     """Get messages for a call (if any)"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
             SELECT * FROM messages 
@@ -967,33 +2527,42 @@ def add_comment(post_id, user_id, content):
         if not content or len(content.strip()) == 0:
             return False, "Comment cannot be empty"
         
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO comments (post_id, user_id, content)
-            VALUES (?, ?, ?)
-        """, (post_id, user_id, content))
-        
-        # Update comment count in posts table
-        c.execute("UPDATE posts SET comment_count = comment_count + 1 WHERE id = ?", (post_id,))
+        with db_transaction() as c:
+            c.execute("""
+                INSERT INTO comments (post_id, user_id, content)
+                VALUES (?, ?, ?)
+            """, (post_id, user_id, content))
+            
+            # Update comment count in posts table
+            c.execute("UPDATE posts SET comment_count = comment_count + 1 WHERE id = ?", (post_id,))
         
-        conn.commit()
         return True, "Comment added successfully"
     except Exception as e:
         return False, f"Failed to add comment: {str(e)}"
 
-def get_comments(post_id, limit=50):
-    """Get comments for a post"""
+def get_comments(post_id, limit=50, cursor=None):
+    """Get comments for a post, newest first
+
+    cursor is the (created_at, id) of the last comment already shown; only
+    older comments are returned.
+    """
     try:
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute("""
-            SELECT c.*, u.username, u.profile_pic, u.display_name
+        query = """
+            SELECT c.*, u.username, u.profile_pic_hash, u.display_name
             FROM comments c
             JOIN users u ON c.user_id = u.id
             WHERE c.post_id = ?
-            ORDER BY c.created_at DESC
-            LIMIT ?
-        """, (post_id, limit))
+        """
+        params = [post_id]
+        if cursor:
+            query += " AND (c.created_at, c.id) < (?, ?)"
+            params.extend(cursor)
+        query += " ORDER BY c.created_at DESC, c.id DESC LIMIT ?"
+        params.append(limit)
         
+        c.execute(query, params)
         return c.fetchall()
     except Exception as e:
         return []
@@ -1001,21 +2570,18 @@ def get_comments(post_id, limit=50):
 def delete_comment(comment_id, user_id):
     """Delete a comment (only if user owns it)"""
     try:
-        c = conn.cursor()
-        
-        # Check if user owns the comment
-        c.execute("SELECT post_id FROM comments WHERE id = ? AND user_id = ?", (comment_id, user_id))
-        result = c.fetchone()
-        
-        if result:
-            post_id = result[0]
-            c.execute("DELETE FROM comments WHERE id = ?", (comment_id,))
+        with db_transaction() as c:
+            # Check if user owns the comment
+            c.execute("SELECT post_id FROM comments WHERE id = ? AND user_id = ?", (comment_id, user_id))
+            result = c.fetchone()
             
-            # Update comment count
-            c.execute("UPDATE posts SET comment_count = comment_count - 1 WHERE id = ?", (post_id,))
-            
-            conn.commit()
-            return True
+            if result:
+                post_id = result[0]
+                c.execute("DELETE FROM comments WHERE id = ?", (comment_id,))
+                
+                # Update comment count
+                c.execute("UPDATE posts SET comment_count = MAX(comment_count - 1, 0) WHERE id = ?", (post_id,))
+                return True
         return False
     except:
         return False
@@ -1024,29 +2590,66 @@ def delete_comment(comment_id, user_id):
 # SHARE FUNCTIONS
 # ===================================
 
-def share_post(user_id, post_id, shared_to_user_id=None):
-    """Share a post to a user or just increment share count"""
+def share_post_to_users(user_id, post_id, recipient_ids):
+    """Share a post with several users in one transaction"""
     try:
-        c = conn.cursor()
+        recipient_ids = [recipient_id for recipient_id in dict.fromkeys(recipient_ids) if recipient_id != user_id]
+        if not recipient_ids:
+            return False, "Pick at least one person to share with"
         
-        # Add to shares table if sharing to a specific user
-        if shared_to_user_id:
-            c.execute("""
+        with db_transaction() as c:
+            c.executemany("""
                 INSERT INTO shares (user_id, post_id, shared_to_user_id)
                 VALUES (?, ?, ?)
-            """, (user_id, post_id, shared_to_user_id))
+            """, [(user_id, post_id, recipient_id) for recipient_id in recipient_ids])
+            c.execute("UPDATE posts SET share_count = share_count + ? WHERE id = ?", (len(recipient_ids), post_id))
         
-        # Update share count in posts table
-        c.execute("UPDATE posts SET share_count = share_count + 1 WHERE id = ?", (post_id,))
-        
-        conn.commit()
-        return True, "Post shared successfully"
+        return True, f"Post shared with {len(recipient_ids)} {'person' if len(recipient_ids) == 1 else 'people'}"
     except Exception as e:
         return False, f"Failed to share post: {str(e)}"
 
+def get_share_targets(user_id):
+    """People a user is likely to share with: recent chat partners, then followed accounts
+
+    Returns [(user_id, username, display_name)], cached per viewer so a feed
+    page builds the list once however many posts it shows.
+    """
+    cache = get_share_target_cache()
+    targets = cache.get(user_id)
+    if targets is not None:
+        return targets
+    
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("""
+            SELECT u.id, u.username, u.display_name
+            FROM (
+                SELECT other_id, MIN(source) AS source, MAX(recent) AS recent
+                FROM (
+                    SELECT CASE WHEN user_low = ? THEN user_high ELSE user_low END AS other_id,
+                           0 AS source, last_message_at AS recent
+                    FROM conversations WHERE user_low = ? OR user_high = ?
+                    UNION ALL
+                    SELECT following_id, 1, created_at FROM follows WHERE follower_id = ?
+                )
+                GROUP BY other_id
+            ) t
+            JOIN users u ON u.id = t.other_id AND u.id != ? AND u.is_active = 1
+            ORDER BY t.source, t.recent DESC
+            LIMIT ?
+        """, (user_id, user_id, user_id, user_id, user_id, THEME_CONFIG['cache']['share_targets_limit']))
+        targets = c.fetchall()
+        cache.set(user_id, targets)
+        return targets
+    except Exception as e:
+        print(f"Error getting share targets: {e}")
+        return []
+
 def get_share_count(post_id):
     """Get share count for a post"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("SELECT share_count FROM posts WHERE id = ?", (post_id,))
         result = c.fetchone()
@@ -1057,6 +2660,7 @@ def get_share_count(post_id):
 def get_user_shares(user_id):
     """Get posts shared by a user"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
             SELECT s.*, p.content, p.media_type, u.username as original_author
@@ -1074,81 +2678,284 @@ def get_user_shares(user_id):
 # MESSAGING FUNCTIONS
 # ===================================
 
+def conversation_pair(user_id, other_user_id):
+    """Key of the conversation between two users: the ids in ascending order"""
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+def message_thread_key(user_id, other_user_id):
+    """Key shared by every message between two users, e.g. '3:17'"""
+    return "%d:%d" % conversation_pair(user_id, other_user_id)
+
 def send_message(sender_id, receiver_id, content, message_type='text', media_data=None, call_data=None):
     """Send a message"""
     try:
         if not content and not media_data and not call_data:
             return False, "Message cannot be empty"
         
-        c = conn.cursor()
-        
         # Convert call_data to JSON if present
         call_data_json = json.dumps(call_data) if call_data else None
+        user_low, user_high = conversation_pair(sender_id, receiver_id)
         
-        c.execute("""
-        INSERT INTO messages (sender_id, receiver_id, content, message_type, media_data, call_data)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, (sender_id, receiver_id, content, message_type, media_data, call_data_json))
+        with db_transaction() as c:
+            c.execute("""
+            INSERT INTO messages (sender_id, receiver_id, content, message_type, media_data, call_data, thread_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (sender_id, receiver_id, content, message_type, media_data, call_data_json,
+                  message_thread_key(sender_id, receiver_id)))
+            message_id = c.lastrowid
+            
+            # Keep the conversation summary in step with the new message
+            c.execute("""
+            INSERT INTO conversations 
+                (user_low, user_high, last_message_id, last_message, last_message_at, unread_low, unread_high)
+            VALUES (?, ?, ?, ?, (SELECT created_at FROM messages WHERE id = ?), ?, ?)
+            ON CONFLICT (user_low, user_high) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_message = excluded.last_message,
+                last_message_at = excluded.last_message_at,
+                unread_low = unread_low + excluded.unread_low,
+                unread_high = unread_high + excluded.unread_high
+            """, (user_low, user_high, message_id, (content or "")[:THEME_CONFIG['messages']['preview_chars']],
+                  message_id, int(receiver_id == user_low), int(receiver_id == user_high)))
+        
+        event = {"type": "message", "message_id": message_id, "sender_id": sender_id, "receiver_id": receiver_id}
+        bus = get_event_bus()
+        bus.publish(("user", receiver_id), event)
+        bus.publish(("user", sender_id), event)
         
-        conn.commit()
         return True, "Message sent successfully"
     except Exception as e:
         return False, f"Failed to send message: {str(e)}"
 
 def get_conversations(user_id):
-    """Get all conversations for a user"""
+    """Get all conversations for a user, most recent first"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
-        c.execute("""
-        SELECT DISTINCT 
-            CASE 
-                WHEN sender_id = ? THEN receiver_id 
-                ELSE sender_id 
-            END as other_user_id,
+        c.execute(f"""
+        SELECT 
+            cv.other_user_id,
             u.username,
-            u.profile_pic,
-            u.is_online,
+            u.profile_pic_hash,
+            (u.is_online AND u.last_seen >= {ONLINE_CUTOFF}) AS is_online,
             u.is_live,
-            MAX(m.created_at) as last_message_time,
-            (SELECT content FROM messages 
-             WHERE ((sender_id = ? AND receiver_id = u.id) OR (sender_id = u.id AND receiver_id = ?))
-             ORDER BY created_at DESC LIMIT 1) as last_message,
-            (SELECT COUNT(*) FROM messages 
-             WHERE sender_id = u.id AND receiver_id = ? AND is_read = 0) as unread_count
-        FROM messages m
-        JOIN users u ON (u.id = m.sender_id OR u.id = m.receiver_id) AND u.id != ?
-        WHERE ? IN (m.sender_id, m.receiver_id)
-        GROUP BY other_user_id
-        ORDER BY last_message_time DESC
-        """, (user_id, user_id, user_id, user_id, user_id, user_id))
+            cv.last_message_at,
+            cv.last_message,
+            cv.unread_count,
+            cv.last_message_id
+        FROM (
+            SELECT user_high AS other_user_id, last_message_at, last_message, unread_low AS unread_count,
+                last_message_id
+            FROM conversations WHERE user_low = ?
+            UNION ALL
+            SELECT user_low, last_message_at, last_message, unread_high, last_message_id
+            FROM conversations WHERE user_high = ?
+        ) cv
+        JOIN users u ON u.id = cv.other_user_id AND u.id != ?
+        ORDER BY cv.last_message_at DESC
+        """, (user_id, user_id, user_id))
+        conversations = c.fetchall()
         
-        return c.fetchall()
+        # Threads read up to their last message but not yet flushed have nothing unread
+        pending = get_read_receipts().pending(user_id)
+        if pending:
+            conversations = [
+                conv[:7] + (0,) + conv[8:]
+                if pending.get(message_thread_key(user_id, conv[0]), 0) >= (conv[8] or 0) else conv
+                for conv in conversations
+            ]
+        
+        return conversations
     except Exception as e:
         return []
 
-def get_messages(user_id, other_user_id, limit=50):
-    """Get messages between two users"""
+class ReadReceiptTracker(BackgroundFlusher):
+    """Coalesces read receipts in memory and writes them back in batches
+
+    A receipt is a high-water mark: the newest message a user has seen in a
+    thread, stored in read_receipts. Marks that do not advance are ignored,
+    and repeated marks for the same thread between flushes collapse into one
+    write, so rendering a chat never opens a write transaction. Known marks
+    are kept in a bounded LRU and seeded from the table on first use.
+    """
+
+    thread_name = "ReadReceiptFlusher"
+
+    def __init__(self, pool: ConnectionPool, flush_interval: float = 3.0, max_entries: int = 10000):
+        super().__init__(pool, flush_interval)
+        self.max_entries = max_entries
+        self._marks: "collections.OrderedDict[Tuple[int, str], int]" = collections.OrderedDict()
+        self._pending: Dict[Tuple[int, str], int] = {}
+
+    def mark(self, user_id: int, thread_key: str, message_id: int) -> bool:
+        """Record that a user has read a thread up to message_id"""
+        key = (user_id, thread_key)
+        with self._lock:
+            known = self._marks.get(key)
+        if known is None:
+            known = self._stored_mark(user_id, thread_key)
+        
+        with self._lock:
+            current = max(known, self._marks.get(key, 0), self._pending.get(key, 0))
+            if message_id <= current:
+                self._remember(key, current)
+                return False
+            self._remember(key, message_id)
+            self._pending[key] = message_id
+        if self._thread is None:
+            self._start()
+        return True
+
+    def _stored_mark(self, user_id: int, thread_key: str) -> int:
+        """The mark saved in read_receipts, or 0 if there is none"""
+        try:
+            c = self.pool.connection().cursor()
+            c.execute("SELECT last_read_id FROM read_receipts WHERE user_id = ? AND thread_key = ?",
+                      (user_id, thread_key))
+            result = c.fetchone()
+            return result[0] if result else 0
+        except Exception:
+            return 0
+
+    def _remember(self, key: Tuple[int, str], message_id: int):
+        """Cache a known mark, evicting the least recently used (caller holds the lock)"""
+        self._marks[key] = message_id
+        self._marks.move_to_end(key)
+        while len(self._marks) > self.max_entries:
+            self._marks.popitem(last=False)
+
+    def pending(self, user_id: int) -> Dict[str, int]:
+        """Unflushed read marks of a user, by thread key"""
+        with self._lock:
+            return {thread_key: message_id for (uid, thread_key), message_id in self._pending.items()
+                    if uid == user_id}
+
+    def flush(self):
+        """Write pending marks, read flags and unread counters in one transaction"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        
+        stored = {}
+        try:
+            with self._batch() as c:
+                for (user_id, thread_key), message_id in pending.items():
+                    c.execute("""
+                        INSERT INTO read_receipts (user_id, thread_key, last_read_id) VALUES (?, ?, ?)
+                        ON CONFLICT (user_id, thread_key) DO UPDATE SET
+                            last_read_id = MAX(last_read_id, excluded.last_read_id),
+                            updated_at = CURRENT_TIMESTAMP
+                    """, (user_id, thread_key, message_id))
+                
+                    # Read flags and unread counts follow the stored mark, which may be
+                    # ahead of this process if another one advanced it
+                    c.execute("SELECT last_read_id FROM read_receipts WHERE user_id = ? AND thread_key = ?",
+                              (user_id, thread_key))
+                    last_read_id = stored[(user_id, thread_key)] = c.fetchone()[0]
+                    c.execute("""
+                        UPDATE messages SET is_read = 1
+                        WHERE thread_key = ? AND receiver_id = ? AND is_read = 0
+                        AND (created_at, id) <= (SELECT created_at, id FROM messages WHERE id = ?)
+                    """, (thread_key, user_id, last_read_id))
+                
+                    # Whatever arrived after the mark stays unread
+                    user_low, user_high = (int(part) for part in thread_key.split(":"))
+                    unread_column = "unread_low" if user_id == user_low else "unread_high"
+                    c.execute(f"""
+                        UPDATE conversations SET {unread_column} = (
+                            SELECT COUNT(*) FROM messages 
+                            WHERE thread_key = ? AND receiver_id = ?
+                            AND (created_at, id) > (SELECT created_at, id FROM messages WHERE id = ?)
+                        )
+                        WHERE user_low = ? AND user_high = ?
+                    """, (thread_key, user_id, last_read_id, user_low, user_high))
+            with self._lock:
+                for key, last_read_id in stored.items():
+                    self._remember(key, max(last_read_id, self._marks.get(key, 0)))
+        except Exception:
+            with self._lock:
+                for key, message_id in pending.items():
+                    self._pending[key] = max(message_id, self._pending.get(key, 0))
+            raise
+
+@st.cache_resource
+def get_read_receipts():
+    """Get the process-wide read receipt tracker"""
+    return ReadReceiptTracker(get_db_pool(), flush_interval=THEME_CONFIG['messages']['read_flush_seconds'],
+                              max_entries=THEME_CONFIG['messages']['read_marks_max_entries'])
+
+def mark_messages_read(user_id, other_user_id, message_id):
+    """Mark a thread as read up to message_id; written back in the background"""
+    return get_read_receipts().mark(user_id, message_thread_key(user_id, other_user_id), message_id)
+
+def search_messages(user_id, search_term, limit=20):
+    """Full-text search over a user's direct messages, best BM25 match first
+
+    Returns (message_id, other_user_id, other_username, content, created_at).
+    """
     try:
+        match = fts_query(search_term)
+        if not match:
+            return []
+        
+        conn = get_db_connection()
         c = conn.cursor()
+        # Walk the user's own messages and probe the index for each one, so other
+        # users' matches are never visited
         c.execute("""
-        SELECT m.*, u.username as sender_username, u.profile_pic
+            SELECT m.id, u.id, u.username, m.content, m.created_at
+            FROM messages m
+            CROSS JOIN messages_fts ON messages_fts.rowid = m.id
+            JOIN users u ON u.id = CASE WHEN m.sender_id = ? THEN m.receiver_id ELSE m.sender_id END
+            WHERE (m.sender_id = ? OR m.receiver_id = ?) AND messages_fts MATCH ?
+            ORDER BY bm25(messages_fts)
+            LIMIT ?
+        """, (user_id, user_id, user_id, match, limit))
+        return c.fetchall()
+    except Exception as e:
+        print(f"Error searching messages: {e}")
+        return []
+
+def get_messages(user_id, other_user_id, limit=50, before_id=None, after_id=None):
+    """Get messages between two users, newest first
+
+    before_id pages back through older history; after_id fetches only the
+    messages newer than one already shown. Both compare on
+    (created_at, id), the order of the thread index.
+    """
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        params = [message_thread_key(user_id, other_user_id)]
+        cursor_filter = ""
+        order = "DESC"
+        if before_id is not None:
+            cursor_filter = "AND (m.created_at, m.id) < (SELECT created_at, id FROM messages WHERE id = ?)"
+            params.append(before_id)
+        elif after_id is not None:
+            # Take the oldest unseen messages first so nothing is skipped
+            cursor_filter = "AND (m.created_at, m.id) > (SELECT created_at, id FROM messages WHERE id = ?)"
+            params.append(after_id)
+            order = "ASC"
+        params.append(limit)
+        
+        c.execute(f"""
+        SELECT m.*, u.username as sender_username, u.profile_pic_hash
         FROM messages m
         JOIN users u ON m.sender_id = u.id
-        WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-           OR (m.sender_id = ? AND m.receiver_id = ?)
-        ORDER BY m.created_at DESC
+        WHERE m.thread_key = ? {cursor_filter}
+        ORDER BY m.created_at {order}, m.id {order}
         LIMIT ?
-        """, (user_id, other_user_id, other_user_id, user_id, limit))
+        """, params)
         
         messages = c.fetchall()
+        if order == "ASC":
+            messages.reverse()
         
-        # Mark messages as read
-        c.execute("""
-        UPDATE messages 
-        SET is_read = 1 
-        WHERE sender_id = ? AND receiver_id = ? AND is_read = 0
-        """, (other_user_id, user_id))
-        conn.commit()
+        # Advance the read mark to the newest message shown (older pages were already seen)
+        if before_id is None and messages:
+            mark_messages_read(user_id, other_user_id, messages[0][0])
         
         return messages
     except Exception as e:
@@ -1164,85 +2971,240 @@ def create_post(user_id, content, media_data=None, media_type=None, location=Non
         if not content or len(content.strip()) == 0:
             return False, "Post content cannot be empty"
             
-        c = conn.cursor()
-        
         # Extract hashtags
-        hashtags_str = extract_hashtags_string(content)
-        
-        c.execute("""
-            INSERT INTO posts 
-            (user_id, content, media_type, media_data, location, language, visibility, hashtags) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, content, media_type, media_data, location, language, visibility, hashtags_str))
+        hashtags = extract_hashtags(content)
+        hashtags_str = ','.join(hashtags)
         
-        post_id = c.lastrowid
+        # Media bytes live in the media store; the row only keeps the hash
+        media_hash = store_media(media_data)
+        media_size = len(media_data) if media_data else 0
+        if media_hash and media_type and 'image' in media_type:
+            create_renditions(media_hash, 'post')
         
-        # Update user post count
-        c.execute("UPDATE users SET post_count = post_count + 1 WHERE id = ?", (user_id,))
+        with db_transaction() as c:
+            c.execute("""
+                INSERT INTO posts 
+                (user_id, content, media_type, media_hash, media_size, location, language, visibility, hashtags) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, content, media_type, media_hash, media_size, location, language, visibility, hashtags_str))
+            
+            post_id = c.lastrowid
+            
+            # Index the post under each of its hashtags
+            c.executemany("""
+                INSERT OR IGNORE INTO post_hashtags (tag, post_id, created_at)
+                SELECT ?, id, created_at FROM posts WHERE id = ?
+            """, [(tag, post_id) for tag in hashtags])
+            
+            # Push the post onto home timelines
+            fan_out_post(c, post_id, user_id, visibility)
+            
+            # Update user post count
+            c.execute("UPDATE users SET post_count = post_count + 1 WHERE id = ?", (user_id,))
         
-        conn.commit()
+        invalidate_user(user_id)
         return True, post_id
     except sqlite3.Error as e:
         return False, f"Post creation failed: {str(e)}"
 
-def get_posts_simple(limit=20, user_id=None):
-    """Get posts with simplified query"""
+# Post columns in the order the UI unpacks them; media is referenced by hash
+POST_COLUMNS = """
+    p.id, p.user_id, p.content, p.media_type, p.media_hash, p.location, p.language,
+    p.visibility, p.is_deleted, p.like_count, p.comment_count, p.share_count,
+    p.view_count, p.hashtags, p.created_at
+"""
+
+def get_post_cursor(post):
+    """Get the (created_at, id) pagination cursor pointing just after a post"""
+    return (post[14], post[0])
+
+def get_posts_simple(limit=20, user_id=None, cursor=None):
+    """Get posts with simplified query
+
+    cursor is a (created_at, id) pair from get_post_cursor; only posts older
+    than it are returned, so every page is a single index range scan.
+    """
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         
+        query = f"""
+            SELECT {POST_COLUMNS}, u.username, u.display_name, u.profile_pic_hash, u.is_live
+            FROM posts p
+            JOIN users u ON p.user_id = u.id
+        """
         if user_id:
-            c.execute("""
-                SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_live
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.is_deleted = 0 AND p.user_id = ?
-                ORDER BY p.created_at DESC
-                LIMIT ?
-            """, (user_id, limit))
+            query += " WHERE p.is_deleted = 0 AND p.user_id = ?"
+            params = [user_id]
         else:
-            c.execute("""
-                SELECT p.*, u.username, u.display_name, u.profile_pic, u.is_live
-                FROM posts p
-                JOIN users u ON p.user_id = u.id
-                WHERE p.is_deleted = 0 AND p.visibility = 'public'
-                ORDER BY p.created_at DESC
-                LIMIT ?
-            """, (limit,))
+            query += " WHERE p.is_deleted = 0 AND p.visibility = 'public'"
+            params = []
+        
+        if cursor:
+            query += " AND (p.created_at, p.id) < (?, ?)"
+            params.extend(cursor)
         
+        query += " ORDER BY p.created_at DESC, p.id DESC LIMIT ?"
+        params.append(limit)
+        
+        c.execute(query, params)
         return c.fetchall()
     except Exception as e:
         print(f"Error getting posts: {e}")
         return []
 
-def get_post_stats(post_id):
-    """Get like and comment counts for a post"""
+def fan_out_post(c, post_id, author_id, visibility):
+    """Push a new post onto the author's timeline and their followers' timelines
+
+    Authors with more than the celebrity threshold of followers are only
+    written to their own timeline; followers merge their posts in at read
+    time instead (see get_following_posts).
+    """
+    c.execute("""
+        INSERT OR IGNORE INTO timelines (user_id, post_id, created_at)
+        SELECT user_id, id, created_at FROM posts WHERE id = ?
+    """, (post_id,))
+    if visibility == 'private':
+        return
+    
+    c.execute("""
+        INSERT OR IGNORE INTO timelines (user_id, post_id, created_at)
+        SELECT f.follower_id, p.id, p.created_at
+        FROM posts p
+        JOIN users u ON u.id = p.user_id AND u.follower_count <= ?
+        JOIN follows f ON f.following_id = p.user_id
+        WHERE p.id = ?
+    """, (THEME_CONFIG['timeline']['celebrity_followers'], post_id))
+
+def get_following_posts(user_id, limit=20, cursor=None):
+    """Get the home timeline of a user: their own posts and those of accounts they follow
+
+    Reads the user's precomputed timeline page and merges in the latest
+    posts of followed celebrity accounts, so the cost is proportional to
+    the page size rather than the size of the posts table. cursor is a
+    (created_at, id) pair from get_post_cursor.
+    """
     try:
+        conn = get_db_connection()
         c = conn.cursor()
+        cursor_filter = " AND ({columns}) < (?, ?)" if cursor else ""
+        cursor_params = list(cursor) if cursor else []
         
-        # Get like count
-        c.execute("SELECT COUNT(*) FROM likes WHERE post_id = ?", (post_id,))
-        like_count = c.fetchone()[0] or 0
+        # Deleted posts are skipped here, before the limit, so pages stay full
+        c.execute(f"""
+            SELECT t.created_at, t.post_id FROM timelines t
+            JOIN posts p ON p.id = t.post_id AND p.is_deleted = 0
+            WHERE t.user_id = ?{cursor_filter.format(columns='t.created_at, t.post_id')}
+            ORDER BY t.created_at DESC, t.post_id DESC LIMIT ?
+        """, [user_id] + cursor_params + [limit])
+        entries = c.fetchall()
         
-        # Get comment count
-        c.execute("SELECT COUNT(*) FROM comments WHERE post_id = ?", (post_id,))
-        comment_count = c.fetchone()[0] or 0
+        # Fan-out-on-read for followed accounts too large to fan out on write
+        c.execute("""
+            SELECT f.following_id FROM follows f
+            JOIN users u ON u.id = f.following_id
+            WHERE f.follower_id = ? AND u.follower_count > ?
+        """, (user_id, THEME_CONFIG['timeline']['celebrity_followers']))
+        for (celebrity_id,) in c.fetchall():
+            c.execute(f"""
+                SELECT created_at, id FROM posts
+                WHERE user_id = ? AND is_deleted = 0 AND visibility != 'private'{cursor_filter.format(columns='created_at, id')}
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            """, [celebrity_id] + cursor_params + [limit])
+            entries.extend(c.fetchall())
         
-        # Get share count
-        c.execute("SELECT share_count FROM posts WHERE id = ?", (post_id,))
-        share_result = c.fetchone()
-        share_count = share_result[0] if share_result else 0
+        # Newest first; a post can appear twice if its author crossed the threshold
+        post_ids = []
+        for created_at, post_id in sorted(set(entries), reverse=True):
+            if post_id not in post_ids:
+                post_ids.append(post_id)
+            if len(post_ids) == limit:
+                break
+        if not post_ids:
+            return []
         
-        return like_count, comment_count, share_count
-    except:
-        return 0, 0, 0
+        c.execute(f"""
+            SELECT {POST_COLUMNS}, u.username, u.display_name, u.profile_pic_hash, u.is_live
+            FROM posts p
+            JOIN users u ON p.user_id = u.id
+            WHERE p.id IN ({','.join('?' * len(post_ids))}) AND p.is_deleted = 0
+        """, post_ids)
+        posts = {post[0]: post for post in c.fetchall()}
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
+    except Exception as e:
+        print(f"Error getting following posts: {e}")
+        return []
+
+def hydrate_feed_posts(post_ids, viewer_id):
+    """Load engagement state for a page of posts in a fixed number of queries
+
+    Returns {post_id: {'like_count', 'comment_count', 'share_count', 'liked',
+    'saved'}} regardless of how many posts are on the page. Comments are
+    loaded separately when a post's comment panel is opened.
+    """
+    hydrated = {
+        post_id: {
+            'like_count': 0,
+            'comment_count': 0,
+            'share_count': 0,
+            'liked': False,
+            'saved': False
+        }
+        for post_id in post_ids
+    }
+    if not hydrated:
+        return hydrated
+
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        ids = list(hydrated.keys())
+        placeholders = ','.join('?' * len(ids))
+
+        # Counts
+        c.execute(f"""
+            SELECT p.id, p.like_count, p.comment_count, p.share_count
+            FROM posts p
+            WHERE p.id IN ({placeholders})
+        """, ids)
+        for post_id, like_count, comment_count, share_count in c.fetchall():
+            hydrated[post_id]['like_count'] = like_count or 0
+            hydrated[post_id]['comment_count'] = comment_count or 0
+            hydrated[post_id]['share_count'] = share_count or 0
+
+        # Viewer's likes and saves
+        c.execute(f"""
+            SELECT post_id FROM likes WHERE user_id = ? AND post_id IN ({placeholders})
+        """, [viewer_id] + ids)
+        for (post_id,) in c.fetchall():
+            hydrated[post_id]['liked'] = True
+
+        c.execute(f"""
+            SELECT post_id FROM saves WHERE user_id = ? AND post_id IN ({placeholders})
+        """, [viewer_id] + ids)
+        for (post_id,) in c.fetchall():
+            hydrated[post_id]['saved'] = True
+
+        return hydrated
+    except Exception as e:
+        print(f"Error hydrating feed posts: {e}")
+        return hydrated
 
 def like_post(user_id, post_id):
     """Like a post"""
     try:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)", 
-                 (user_id, post_id))
-        conn.commit()
+        owner_ids = []
+        with db_transaction() as c:
+            c.execute("INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)", 
+                     (user_id, post_id))
+            if c.rowcount:
+                # Counters move only when the like is new
+                c.execute("UPDATE posts SET like_count = like_count + 1 WHERE id = ?", (post_id,))
+                c.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,))
+                owner_ids = [row[0] for row in c.fetchall()]
+                c.executemany("UPDATE users SET total_likes = total_likes + 1 WHERE id = ?",
+                              [(owner_id,) for owner_id in owner_ids])
+        invalidate_user(*owner_ids)
         return True
     except:
         return False
@@ -1250,27 +3212,25 @@ def like_post(user_id, post_id):
 def unlike_post(user_id, post_id):
     """Unlike a post"""
     try:
-        c = conn.cursor()
-        c.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ?", 
-                 (user_id, post_id))
-        conn.commit()
+        owner_ids = []
+        with db_transaction() as c:
+            c.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ?", 
+                     (user_id, post_id))
+            if c.rowcount:
+                c.execute("UPDATE posts SET like_count = MAX(like_count - 1, 0) WHERE id = ?", (post_id,))
+                c.execute("SELECT user_id FROM posts WHERE id = ?", (post_id,))
+                owner_ids = [row[0] for row in c.fetchall()]
+                c.executemany("UPDATE users SET total_likes = MAX(total_likes - 1, 0) WHERE id = ?",
+                              [(owner_id,) for owner_id in owner_ids])
+        invalidate_user(*owner_ids)
         return True
     except:
         return False
 
-def has_liked_post(user_id, post_id):
-    """Check if user has liked a post"""
-    try:
-        c = conn.cursor()
-        c.execute("SELECT id FROM likes WHERE user_id = ? AND post_id = ?", 
-                 (user_id, post_id))
-        return c.fetchone() is not None
-    except:
-        return False
-
 def save_post(user_id, post_id):
     """Save a post to bookmarks"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("INSERT OR IGNORE INTO saves (user_id, post_id) VALUES (?, ?)", 
                  (user_id, post_id))
@@ -1282,6 +3242,7 @@ def save_post(user_id, post_id):
 def unsave_post(user_id, post_id):
     """Remove post from saves"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("DELETE FROM saves WHERE user_id = ? AND post_id = ?", 
                  (user_id, post_id))
@@ -1290,23 +3251,28 @@ def unsave_post(user_id, post_id):
     except:
         return False
 
-def is_saved(user_id, post_id):
-    """Check if post is saved"""
-    try:
-        c = conn.cursor()
-        c.execute("SELECT id FROM saves WHERE user_id = ? AND post_id = ?", 
-                 (user_id, post_id))
-        return c.fetchone() is not None
-    except:
-        return False
-
 def follow_user(follower_id, following_id):
     """Follow a user"""
     try:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO follows (follower_id, following_id) VALUES (?, ?)", 
-                 (follower_id, following_id))
-        conn.commit()
+        with db_transaction() as c:
+            c.execute("INSERT OR IGNORE INTO follows (follower_id, following_id) VALUES (?, ?)", 
+                     (follower_id, following_id))
+            if c.rowcount:
+                c.execute("UPDATE users SET following_count = following_count + 1 WHERE id = ?", (follower_id,))
+                c.execute("UPDATE users SET follower_count = follower_count + 1 WHERE id = ?", (following_id,))
+                
+                # Seed the follower's timeline with the account's recent posts
+                c.execute("""
+                    INSERT OR IGNORE INTO timelines (user_id, post_id, created_at)
+                    SELECT ?, p.id, p.created_at
+                    FROM posts p
+                    JOIN users u ON u.id = p.user_id AND u.follower_count <= ?
+                    WHERE p.user_id = ? AND p.is_deleted = 0 AND p.visibility != 'private'
+                    ORDER BY p.created_at DESC LIMIT ?
+                """, (follower_id, THEME_CONFIG['timeline']['celebrity_followers'], following_id,
+                      THEME_CONFIG['timeline']['backfill_posts']))
+        invalidate_user(follower_id, following_id)
+        get_share_target_cache().invalidate(follower_id)
         return True
     except:
         return False
@@ -1314,10 +3280,20 @@ def follow_user(follower_id, following_id):
 def unfollow_user(follower_id, following_id):
     """Unfollow a user"""
     try:
-        c = conn.cursor()
-        c.execute("DELETE FROM follows WHERE follower_id = ? AND following_id = ?", 
-                 (follower_id, following_id))
-        conn.commit()
+        with db_transaction() as c:
+            c.execute("DELETE FROM follows WHERE follower_id = ? AND following_id = ?", 
+                     (follower_id, following_id))
+            if c.rowcount:
+                c.execute("UPDATE users SET following_count = MAX(following_count - 1, 0) WHERE id = ?",
+                          (follower_id,))
+                c.execute("UPDATE users SET follower_count = MAX(follower_count - 1, 0) WHERE id = ?",
+                          (following_id,))
+                c.execute("""
+                    DELETE FROM timelines 
+                    WHERE user_id = ? AND post_id IN (SELECT id FROM posts WHERE user_id = ?)
+                """, (follower_id, following_id))
+        invalidate_user(follower_id, following_id)
+        get_share_target_cache().invalidate(follower_id)
         return True
     except:
         return False
@@ -1325,6 +3301,7 @@ def unfollow_user(follower_id, following_id):
 def is_following(follower_id, following_id):
     """Check if user is following another user"""
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("SELECT id FROM follows WHERE follower_id = ? AND following_id = ?", 
                  (follower_id, following_id))
@@ -1332,31 +3309,94 @@ def is_following(follower_id, following_id):
     except:
         return False
 
-def get_trending_hashtags(limit=10):
-    """Get trending hashtags"""
+def get_trending_hashtags(limit=10, window="24h"):
+    """Get the most used hashtags of a recent window ('1h', '24h' or '7d')
+
+    Counts come from a range scan of the hashtag index over the window, so
+    older posts are never read. Only public, undeleted posts count, the same
+    posts get_hashtag_posts shows for a tag.
+    """
     try:
+        conn = get_db_connection()
         c = conn.cursor()
         c.execute("""
-            SELECT 
-                TRIM(REPLACE(REPLACE(hashtags, '#', ''), ' ', '')) as tag,
-                COUNT(*) as post_count
-            FROM posts 
-            WHERE hashtags != '' 
-            GROUP BY tag 
-            ORDER BY post_count DESC 
+            SELECT h.tag, COUNT(*) as post_count
+            FROM post_hashtags h INDEXED BY idx_post_hashtags_recent
+            JOIN posts p ON p.id = h.post_id AND p.is_deleted = 0 AND p.visibility = 'public'
+            WHERE h.created_at >= datetime('now', ?)
+            GROUP BY h.tag 
+            ORDER BY post_count DESC, tag 
             LIMIT ?
-        """, (limit,))
+        """, (THEME_CONFIG['trending_windows'][window], limit))
         return c.fetchall()
     except:
         return []
 
+def get_hashtag_posts(tag, limit=20, cursor=None):
+    """Get public posts with a hashtag, newest first, straight from the hashtag index
+
+    cursor is a (created_at, id) pair from get_post_cursor.
+    """
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        
+        query = f"""
+            SELECT {POST_COLUMNS}, u.username, u.display_name, u.profile_pic_hash, u.is_live
+            FROM post_hashtags h
+            JOIN posts p ON p.id = h.post_id
+            JOIN users u ON p.user_id = u.id
+            WHERE h.tag = ? AND p.is_deleted = 0 AND p.visibility = 'public'
+        """
+        params = [tag.lstrip('#').lower()]
+        if cursor:
+            query += " AND (h.created_at, h.post_id) < (?, ?)"
+            params.extend(cursor)
+        
+        query += " ORDER BY h.created_at DESC, h.post_id DESC LIMIT ?"
+        params.append(limit)
+        
+        c.execute(query, params)
+        return c.fetchall()
+    except Exception as e:
+        print(f"Error getting hashtag posts: {e}")
+        return []
+
+def search_posts(search_term, limit=20):
+    """Full-text search over public posts, best BM25 match first"""
+    try:
+        match = fts_query(search_term)
+        if not match:
+            return []
+        
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT {POST_COLUMNS}, u.username, u.display_name, u.profile_pic_hash, u.is_live
+            FROM posts_fts
+            JOIN posts p ON p.id = posts_fts.rowid
+            JOIN users u ON p.user_id = u.id
+            WHERE posts_fts MATCH ? AND p.is_deleted = 0 AND p.visibility = 'public'
+            ORDER BY bm25(posts_fts)
+            LIMIT ?
+        """, (match, limit))
+        return c.fetchall()
+    except Exception as e:
+        print(f"Error searching posts: {e}")
+        return []
+
 # ===================================
 # MEDIA DISPLAY FUNCTIONS
 # ===================================
 
 def display_media(media_data, media_type, caption=""):
-    """Display media (image or video)"""
+    """Display media (image or video) from bytes or a media store digest"""
     try:
+        if MediaStore.is_digest(media_data):
+            if media_type and 'image' in media_type:
+                media_data = load_rendition(media_data, 'feed')
+            else:
+                media_data = load_media(media_data)
         if media_data:
             if media_type and 'video' in media_type:
                 # Display video
@@ -1370,8 +3410,10 @@ def display_media(media_data, media_type, caption=""):
         return False
 
 def display_profile_pic(profile_pic, username, size=40):
-    """Display profile picture with fallback"""
+    """Display profile picture (bytes or media store digest) with fallback"""
     try:
+        if MediaStore.is_digest(profile_pic):
+            profile_pic = load_avatar(profile_pic, size)
         if profile_pic:
             st.image(profile_pic, width=size)
         else:
@@ -1415,6 +3457,32 @@ def display_profile_pic(profile_pic, username, size=40):
 # LIVE STREAMING PAGE
 # ===================================
 
+@st.fragment(run_every=THEME_CONFIG['live']['chat_refresh_seconds'])
+def stream_chat_panel(stream_id, limit=30, can_send=False):
+    """Live chat for a stream; reruns on its own and fetches only new messages"""
+    chats = st.session_state.setdefault('stream_chats', {})
+    messages = chats.get(stream_id)
+    changed = events_changed("stream_chat", ("stream", stream_id))
+    if messages is None or (changed and not messages):
+        messages = list(reversed(get_stream_messages(stream_id, limit=limit)))
+    elif changed:
+        messages.extend(reversed(get_stream_messages(stream_id, limit=limit, after_id=messages[-1][0])))
+    chats[stream_id] = messages = messages[-limit:]
+    
+    st.markdown("".join(f"""
+    <div class='chat-message'>
+        <strong>@{msg[5]}:</strong> {msg[3]}
+    </div>
+    """ for msg in reversed(messages) if len(msg) > 5), unsafe_allow_html=True)
+    
+    if can_send:
+        with st.form("stream_chat_form", clear_on_submit=True):
+            chat_message = st.text_input("Type a message...", key=f"chat_{stream_id}")
+            if st.form_submit_button("Send"):
+                if chat_message:
+                    send_stream_message(stream_id, st.session_state.user_id, chat_message)
+                    st.rerun(scope="fragment")
+
 def live_streaming_page():
     """Live streaming page with WebRTC"""
     st.markdown("<h1 style='text-align: center;'>📡 Live Streaming</h1>", unsafe_allow_html=True)
@@ -1481,7 +3549,10 @@ def live_streaming_page():
                     {"iceServers": THEME_CONFIG['webrtc']['ice_servers']}
                 )
                 
-                # Create WebRTC streamer for host
+                # Create WebRTC streamer for host; processed frames are relayed to viewers
+                presence = get_stream_presence()
+                relay = get_stream_relay()
+                stream_title = stream[3] or ""
                 webrtc_ctx = webrtc_streamer(
                     key=f"host-{stream_id}",
                     mode=WebRtcMode.SENDONLY,
@@ -1490,26 +3561,15 @@ def live_streaming_page():
                         "video": True,
                         "audio": True,
                     },
-                    video_processor_factory=lambda: VideoProcessor(stream_id, is_host=True),
-                    audio_processor_factory=lambda: AudioProcessor(stream_id),
+                    video_processor_factory=lambda: VideoProcessor(stream_id, is_host=True, presence=presence,
+                                                                   title=stream_title, relay=relay),
+                    audio_processor_factory=lambda: AudioProcessor(stream_id, is_host=True, relay=relay),
                     async_processing=True,
                 )
                 
                 # Stream chat
                 st.markdown("### Stream Chat")
-                chat_container = st.container()
-                
-                with chat_container:
-                    messages = get_stream_messages(stream_id, limit=20)
-                    for msg in messages:
-                        if len(msg) > 4:
-                            username = msg[5]
-                            message = msg[3]
-                            st.markdown(f"""
-                            <div class='chat-message'>
-                                <strong>@{username}:</strong> {message}
-                            </div>
-                            """, unsafe_allow_html=True)
+                stream_chat_panel(stream_id, limit=20)
     
     with tab2:
         st.markdown("### Live Now")
@@ -1522,9 +3582,9 @@ def live_streaming_page():
                 if len(stream) > 10:
                     stream_id = stream[2]  # stream_id
                     title = stream[3]
-                    username = stream[13]  # username
-                    display_name = stream[14]
-                    profile_pic = stream[15]
+                    username = stream[12]  # username
+                    display_name = stream[13]
+                    profile_pic = stream[14]
                     viewer_count = stream[5]
                     
                     col1, col2 = st.columns([1, 4])
@@ -1554,7 +3614,7 @@ def live_streaming_page():
                     st.markdown("---")
                     st.markdown("### Watching Stream")
                     
-                    # Add viewer
+                    # Heartbeat; the viewer's relay track keeps it alive between reruns
                     add_stream_viewer(stream_id, st.session_state.user_id)
                     
                     # WebRTC viewer
@@ -1562,50 +3622,42 @@ def live_streaming_page():
                         {"iceServers": THEME_CONFIG['webrtc']['ice_servers']}
                     )
                     
+                    # Each WebRTC session gets its own relay tracks, which the
+                    # library stops when the connection ends
+                    relay = get_stream_relay()
+                    viewer_id = st.session_state.user_id
+                    max_layer = None
+                    if relay.layers:
+                        quality = st.selectbox("Quality", ["Auto"] + [f"{layer}p" for layer in relay.layers],
+                                               key=f"quality_{stream_id}")
+                        max_layer = None if quality == "Auto" else int(quality[:-1])
+                        relay.set_max_layer(stream_id, viewer_id, max_layer)
                     webrtc_ctx = webrtc_streamer(
                         key=f"viewer-{stream_id}",
                         mode=WebRtcMode.RECVONLY,
                         rtc_configuration=rtc_configuration,
-                        video_processor_factory=lambda: VideoProcessor(stream_id, is_host=False),
-                        audio_processor_factory=lambda: AudioProcessor(stream_id),
-                        async_processing=True,
+                        media_stream_constraints={
+                            "video": True,
+                            "audio": True,
+                        },
+                        player_factory=lambda: relay.player(stream_id, viewer_id=viewer_id, max_layer=max_layer),
                     )
                     
                     # Stream info
                     col1, col2 = st.columns([3, 1])
                     with col1:
                         st.markdown(f"**{stream[3]}**")
-                        st.caption(f"Streaming by @{stream[13]}")
+                        st.caption(f"Streaming by @{stream[12]}")
                     with col2:
                         if st.button("❌ Leave Stream"):
+                            relay.stop_viewer(stream_id, st.session_state.user_id)
                             remove_stream_viewer(stream_id, st.session_state.user_id)
                             st.session_state.watch_stream = None
                             st.rerun()
                     
                     # Stream chat
                     st.markdown("### Live Chat")
-                    
-                    # Display messages
-                    chat_container = st.container()
-                    with chat_container:
-                        messages = get_stream_messages(stream_id, limit=30)
-                        for msg in messages:
-                            if len(msg) > 4:
-                                username = msg[5]
-                                message = msg[3]
-                                st.markdown(f"""
-                                <div class='chat-message'>
-                                    <strong>@{username}:</strong> {message}
-                                </div>
-                                """, unsafe_allow_html=True)
-                    
-                    # Send message
-                    with st.form("stream_chat_form", clear_on_submit=True):
-                        chat_message = st.text_input("Type a message...", key=f"chat_{stream_id}")
-                        if st.form_submit_button("Send"):
-                            if chat_message:
-                                send_stream_message(stream_id, st.session_state.user_id, chat_message)
-                                st.rerun()
+                    stream_chat_panel(stream_id, limit=30, can_send=True)
         else:
             st.info("No live streams at the moment. Be the first to go live!")
 
@@ -1731,34 +3783,68 @@ def feed_page():
     """Feed Chat vertical feed with comments and sharing"""
     st.markdown("<h1 style='text-align: center;'>🎬 Your Feed</h1>", unsafe_allow_html=True)
     
-    # For You feed
-    posts = get_posts_simple(limit=10)
+    page_size = 10
+    
+    # For You (all public posts) or Following (home timeline), one keyset page at a time
+    feed_mode = st.radio("Feed", ["For You", "Following"], horizontal=True, label_visibility="collapsed",
+                         key="feed_mode")
+    cursor_key = 'feed_cursor' if feed_mode == "For You" else 'following_cursor'
+    cursor = st.session_state.get(cursor_key)
+    if feed_mode == "For You":
+        posts = get_posts_simple(limit=page_size + 1, cursor=cursor)
+    else:
+        posts = get_following_posts(st.session_state.user_id, limit=page_size + 1, cursor=cursor)
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
     
     if not posts:
-        st.info("No posts yet. Create your first post!")
+        if cursor:
+            st.info("You're all caught up!")
+            if st.button("⬆️ Back to Latest", use_container_width=True):
+                st.session_state[cursor_key] = None
+                st.rerun()
+        elif feed_mode == "Following":
+            st.info("Follow some accounts to fill your Following feed!")
+        else:
+            st.info("No posts yet. Create your first post!")
         return
     
+    # Load counts, likes, saves and comments for the whole page at once
+    feed_state = hydrate_feed_posts([post[0] for post in posts], st.session_state.user_id)
+    
     # Display posts
     for post in posts:
         try:
-            display_feed_post_with_comments(post)
+            display_feed_post_with_comments(post, feed_state.get(post[0]))
         except Exception as e:
             st.error(f"Error displaying post: {e}")
             continue
     
-    # Load more button
-    if st.button("Load More", use_container_width=True):
-        st.rerun()
+    # Pagination buttons
+    col1, col2 = st.columns(2)
+    with col1:
+        if cursor and st.button("⬆️ Back to Latest", use_container_width=True):
+            st.session_state[cursor_key] = None
+            st.rerun()
+    with col2:
+        if has_more and st.button("Load More", use_container_width=True):
+            st.session_state[cursor_key] = get_post_cursor(posts[-1])
+            st.rerun()
 
-def display_feed_post_with_comments(post):
-    """Display post with comments and sharing features"""
+def display_feed_post_with_comments(post, post_state=None, key_prefix=""):
+    """Display post with comments and sharing features
+
+    post_state is this post's entry from hydrate_feed_posts; when omitted the
+    post is hydrated on its own. key_prefix keeps widget keys unique when the
+    same post can show up in two sections of one page.
+    """
     try:
         # Safe unpacking
         post_id = post[0] if len(post) > 0 else 0
         user_id = post[1] if len(post) > 1 else 0
         content = post[2] if len(post) > 2 else ""
         media_type = post[3] if len(post) > 3 else None
-        media_data = post[4] if len(post) > 4 else None
+        media_hash = post[4] if len(post) > 4 else None
         location = post[5] if len(post) > 5 else ""
         language = post[6] if len(post) > 6 else "en"
         visibility = post[7] if len(post) > 7 else "public"
@@ -1772,6 +3858,9 @@ def display_feed_post_with_comments(post):
         if is_deleted:
             return
         
+        if post_state is None:
+            post_state = hydrate_feed_posts([post_id], st.session_state.user_id)[post_id]
+        
         with st.container():
             st.markdown("---")
             
@@ -1788,7 +3877,7 @@ def display_feed_post_with_comments(post):
                         st.markdown("<span class='live-badge'>LIVE</span>", unsafe_allow_html=True)
                 with col_b:
                     # Call button
-                    if st.button("📞", key=f"call_{post_id}", help="Start video call"):
+                    if st.button("📞", key=f"{key_prefix}call_{post_id}", help="Start video call"):
                         st.session_state.call_user = user_id
                         st.rerun()
                 
@@ -1801,8 +3890,8 @@ def display_feed_post_with_comments(post):
                 st.markdown(f"{content}")
             
             # Display media if exists
-            if media_data and media_type:
-                display_media(media_data, media_type)
+            if media_hash and media_type:
+                display_media(media_hash, media_type)
             
             # Hashtags
             hashtags = post[13] if len(post) > 13 else ""
@@ -1812,16 +3901,18 @@ def display_feed_post_with_comments(post):
                     if tag.strip():
                         st.markdown(f"<span class='hashtag'>#{tag.strip()}</span>", unsafe_allow_html=True)
             
-            # Get current stats
-            current_likes, current_comments, current_shares = get_post_stats(post_id)
+            # Current stats
+            current_likes = post_state['like_count']
+            current_comments = post_state['comment_count']
+            current_shares = post_state['share_count']
             
             # Engagement buttons
             col_a, col_b, col_c, col_d = st.columns(4)
             
             with col_a:
-                liked = has_liked_post(st.session_state.user_id, post_id)
+                liked = post_state['liked']
                 like_text = "❤️" if not liked else "💔"
-                if st.button(f"{like_text}\n{current_likes}", key=f"like_{post_id}", use_container_width=True):
+                if st.button(f"{like_text}\n{current_likes}", key=f"{key_prefix}like_{post_id}", use_container_width=True):
                     if liked:
                         unlike_post(st.session_state.user_id, post_id)
                     else:
@@ -1829,33 +3920,17 @@ def display_feed_post_with_comments(post):
                     st.rerun()
             
             with col_b:
-                comment_expander = st.expander(f"💬 {current_comments} Comments")
-                with comment_expander:
-                    # Display existing comments
-                    comments = get_comments(post_id)
-                    if comments:
-                        for comment in comments:
-                            col1, col2 = st.columns([1, 10])
-                            with col1:
-                                comment_username = comment[5] if len(comment) > 5 else "Unknown"
-                                comment_profile_pic = comment[6] if len(comment) > 6 else None
-                                display_profile_pic(comment_profile_pic, comment_username, size=30)
-                            with col2:
-                                st.markdown(f"**@{comment_username}**")
-                                st.markdown(comment[3] if len(comment) > 3 else "")
-                                st.caption(f"🕒 {format_tiktok_time(comment[4] if len(comment) > 4 else '')}")
-                    
-                    # Add new comment
-                    with st.form(f"comment_form_{post_id}", clear_on_submit=True):
-                        new_comment = st.text_area("Add a comment...", key=f"comment_text_{post_id}", height=60)
-                        if st.form_submit_button("Post Comment", use_container_width=True):
-                            if new_comment:
-                                success, result = add_comment(post_id, st.session_state.user_id, new_comment)
-                                if success:
-                                    st.success("Comment added!")
-                                    st.rerun()
-                                else:
-                                    st.error(result)
+                # Comments are only queried once the panel is opened
+                open_comments = st.session_state.setdefault('open_comments', {})
+                comments_open = post_id in open_comments
+                comment_icon = "🔽" if comments_open else "💬"
+                if st.button(f"{comment_icon}\n{current_comments}", key=f"{key_prefix}comments_{post_id}",
+                             use_container_width=True):
+                    if comments_open:
+                        open_comments.pop(post_id, None)
+                    else:
+                        open_comments[post_id] = None
+                    st.rerun()
             
             with col_c:
                 share_expander = st.expander(f"↪️ {current_shares} Shares")
@@ -1864,65 +3939,168 @@ def display_feed_post_with_comments(post):
                     
                     # Option 1: Copy link
                     post_link = f"https://feedchat.app/post/{post_id}"
-                    if st.button("📋 Copy Link", key=f"copy_link_{post_id}", use_container_width=True):
+                    if st.button("📋 Copy Link", key=f"{key_prefix}copy_link_{post_id}", use_container_width=True):
                         st.write(f"Link copied: {post_link}")
                         st.info("Link copied to clipboard!")
                     
                     # Option 2: Share to specific users
                     st.markdown("---")
                     st.markdown("### Share with users")
-                    users = get_global_users(limit=20)
-                    for user in users:
-                        if len(user) > 1 and user[0] != st.session_state.user_id:
-                            share_user_id = user[0]
-                            share_username = user[1]
-                            
-                            col1, col2 = st.columns([3, 1])
-                            with col1:
-                                st.markdown(f"**@{share_username}**")
-                            with col2:
-                                if st.button("Send", key=f"share_{post_id}_{share_user_id}", use_container_width=True):
-                                    success, result = share_post(st.session_state.user_id, post_id, share_user_id)
-                                    if success:
-                                        st.success(f"Shared with @{share_username}!")
-                                    else:
-                                        st.error(result)
+                    targets = get_share_targets(st.session_state.user_id)
+                    if targets:
+                        names = {target_id: f"@{username}" + (f" ({display_name})" if display_name and display_name != username else "")
+                                 for target_id, username, display_name in targets}
+                        recipients = st.multiselect("Send to", list(names), format_func=names.get,
+                                                    key=f"{key_prefix}share_to_{post_id}", placeholder="Search people...")
+                        if st.button("Send", key=f"{key_prefix}share_send_{post_id}", use_container_width=True,
+                                     disabled=not recipients):
+                            success, result = share_post_to_users(st.session_state.user_id, post_id, recipients)
+                            if success:
+                                st.success(result)
+                            else:
+                                st.error(result)
+                    else:
+                        st.caption("Follow people or start a chat to share posts with them")
             
             with col_d:
-                saved = is_saved(st.session_state.user_id, post_id)
+                saved = post_state['saved']
                 save_text = "⬇️" if not saved else "✅"
-                if st.button(f"{save_text}\nSave", key=f"save_{post_id}", use_container_width=True):
+                if st.button(f"{save_text}\nSave", key=f"{key_prefix}save_{post_id}", use_container_width=True):
                     if saved:
                         unsave_post(st.session_state.user_id, post_id)
                     else:
                         save_post(st.session_state.user_id, post_id)
                     st.rerun()
+            
+            if post_id in st.session_state.get('open_comments', {}):
+                display_post_comments(post_id, current_comments, key_prefix)
                     
     except Exception as e:
         st.error(f"Error displaying post: {e}")
 
+def display_post_comments(post_id, comment_count, key_prefix=""):
+    """Comment panel of an opened post, loaded 10 comments at a time"""
+    page_size = 10
+    open_comments = st.session_state.setdefault('open_comments', {})
+    panel = open_comments.get(post_id)
+    if panel is None:
+        comments = get_comments(post_id, limit=page_size + 1)
+        panel = {'comments': comments[:page_size], 'has_more': len(comments) > page_size}
+        open_comments[post_id] = panel
+    
+    # Display loaded comments
+    comments = panel['comments']
+    for comment in comments:
+        col1, col2 = st.columns([1, 10])
+        with col1:
+            comment_username = comment[5] if len(comment) > 5 else "Unknown"
+            comment_profile_pic = comment[6] if len(comment) > 6 else None
+            display_profile_pic(comment_profile_pic, comment_username, size=30)
+        with col2:
+            st.markdown(f"**@{comment_username}**")
+            st.markdown(comment[3] if len(comment) > 3 else "")
+            st.caption(f"🕒 {format_tiktok_time(comment[4] if len(comment) > 4 else '')}")
+    
+    if panel['has_more']:
+        st.caption(f"Showing latest {len(comments)} of {comment_count} comments")
+        if st.button("Load more comments", key=f"{key_prefix}more_comments_{post_id}", use_container_width=True):
+            older = get_comments(post_id, limit=page_size + 1, cursor=(comments[-1][4], comments[-1][0]))
+            panel['comments'] = comments + older[:page_size]
+            panel['has_more'] = len(older) > page_size
+            st.rerun()
+    
+    # Add new comment
+    with st.form(f"{key_prefix}comment_form_{post_id}", clear_on_submit=True):
+        new_comment = st.text_area("Add a comment...", key=f"{key_prefix}comment_text_{post_id}", height=60)
+        if st.form_submit_button("Post Comment", use_container_width=True):
+            if new_comment:
+                success, result = add_comment(post_id, st.session_state.user_id, new_comment)
+                if success:
+                    # Reload from the newest comment
+                    open_comments[post_id] = None
+                    st.success("Comment added!")
+                    st.rerun()
+                else:
+                    st.error(result)
+
 # ===================================
 # DISCOVER PAGE
 # ===================================
 
+def hashtag_page(tag):
+    """Posts under one hashtag, a keyset page at a time"""
+    page_size = 10
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        st.markdown(f"### #{tag}")
+    with col2:
+        if st.button("✖️ Close", key="close_hashtag", use_container_width=True):
+            st.session_state.hashtag = None
+            st.session_state.hashtag_cursor = None
+            st.rerun()
+    
+    cursor = st.session_state.get('hashtag_cursor')
+    posts = get_hashtag_posts(tag, limit=page_size + 1, cursor=cursor)
+    has_more = len(posts) > page_size
+    posts = posts[:page_size]
+    
+    if not posts:
+        st.info("No posts with this hashtag yet")
+        return
+    
+    post_state = hydrate_feed_posts([post[0] for post in posts], st.session_state.user_id)
+    for post in posts:
+        display_feed_post_with_comments(post, post_state.get(post[0]), key_prefix="hashtag_")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if cursor and st.button("⬆️ Newest", key="hashtag_newest", use_container_width=True):
+            st.session_state.hashtag_cursor = None
+            st.rerun()
+    with col2:
+        if has_more and st.button("More Posts", key="hashtag_more", use_container_width=True):
+            st.session_state.hashtag_cursor = get_post_cursor(posts[-1])
+            st.rerun()
+
 def discover_page():
     """Discover page with trending content"""
     st.markdown("<h1 style='text-align: center;'>🔍 Discover</h1>", unsafe_allow_html=True)
     
     # Search bar
-    search_query = st.text_input("", placeholder="Search users...", label_visibility="collapsed")
+    search_query = st.text_input("", placeholder="Search users and posts...", label_visibility="collapsed")
+    
+    # Matching posts
+    if search_query:
+        found_posts = search_posts(search_query, limit=5)
+        if found_posts:
+            st.markdown("### 📝 Posts")
+            post_state = hydrate_feed_posts([post[0] for post in found_posts], st.session_state.user_id)
+            for post in found_posts:
+                display_feed_post_with_comments(post, post_state.get(post[0]), key_prefix="search_")
     
     # Trending hashtags
     st.markdown("### 🔥 Trending Hashtags")
-    trending_hashtags = get_trending_hashtags(10)
+    window = st.radio("Trending window", list(THEME_CONFIG['trending_windows']), index=1,
+                      horizontal=True, label_visibility="collapsed")
+    trending_hashtags = get_trending_hashtags(10, window)
     
     if trending_hashtags:
         cols = st.columns(3)
         for idx, hashtag in enumerate(trending_hashtags):
             tag, count = hashtag
             with cols[idx % 3]:
-                st.markdown(f"**#{tag}**")
+                if st.button(f"#{tag}", key=f"tag_{tag}", use_container_width=True):
+                    st.session_state.hashtag = tag
+                    st.session_state.hashtag_cursor = None
+                    st.rerun()
                 st.caption(f"{count} posts")
+    else:
+        st.caption("No hashtags in this window yet")
+    
+    # Posts for the selected hashtag
+    if st.session_state.get('hashtag'):
+        hashtag_page(st.session_state.hashtag)
     
     # Suggested accounts
     st.markdown("### 👥 Suggested For You")
@@ -2116,7 +4294,10 @@ def profile_page():
         
         # User's posts
         st.markdown("### 📸 Your Posts")
-        user_posts = get_posts_simple(user_id=st.session_state.user_id, limit=12)
+        profile_cursor = st.session_state.get('profile_cursor')
+        user_posts = get_posts_simple(user_id=st.session_state.user_id, limit=13, cursor=profile_cursor)
+        has_more_posts = len(user_posts) > 12
+        user_posts = user_posts[:12]
         
         if user_posts:
             cols = st.columns(3)
@@ -2124,27 +4305,129 @@ def profile_page():
                 if len(post) > 4:
                     with cols[idx % 3]:
                         if post[3]:  # media_type
-                            if post[4]:  # media_data
+                            if post[4]:  # media_hash
                                 try:
                                     if 'image' in post[3]:
-                                        st.image(post[4], use_container_width=True)
+                                        st.image(load_rendition(post[4], 'grid'), use_container_width=True)
                                     elif 'video' in post[3]:
-                                        st.video(post[4])
+                                        st.video(load_media(post[4]))
                                 except:
                                     st.markdown(f"<div class='post-card'>{post[2][:100] if len(post) > 2 else 'Post'}</div>", unsafe_allow_html=True)
                         else:
                             st.markdown(f"<div class='post-card'>{post[2][:100] if len(post) > 2 else 'Post'}</div>", unsafe_allow_html=True)
 
+            col1, col2 = st.columns(2)
+            with col1:
+                if profile_cursor and st.button("⬆️ Newest Posts", key="profile_newest", use_container_width=True):
+                    st.session_state.profile_cursor = None
+                    st.rerun()
+            with col2:
+                if has_more_posts and st.button("More Posts", key="profile_more", use_container_width=True):
+                    st.session_state.profile_cursor = get_post_cursor(user_posts[-1])
+                    st.rerun()
+
 # ===================================
 # MESSAGES PAGE
 # ===================================
 
-def messages_page():
-    """Messages page for chatting with other users"""
-    st.markdown("<h1 style='text-align: center;'>💬 Messages</h1>", unsafe_allow_html=True)
+def render_chat_message(msg, user_id):
+    """HTML for one chat bubble"""
+    if len(msg) <= 3:
+        return ""
     
-    # Check for incoming calls
-    active_call = get_active_call(st.session_state.user_id)
+    content = msg[3]
+    sender_id = msg[1]
+    message_type = msg[4] if len(msg) > 4 else 'text'
+    call_data = msg[6] if len(msg) > 6 else None
+    created_at = msg[8] if len(msg) > 8 else ""
+    
+    if message_type == 'call' and call_data:
+        # Parse call data
+        call_info = json.loads(call_data) if isinstance(call_data, str) else call_data
+        if call_info:
+            content = f"📞 {content}"
+    
+    if sender_id == user_id:
+        return f"""
+        <div style='text-align: right; margin: 5px;'>
+            <div style='display: inline-block; background: linear-gradient(45deg, #FF0050, #00F2EA); 
+                    color: white; padding: 10px 15px; border-radius: 18px 18px 4px 18px;'>
+                {content}
+            </div>
+            <div style='font-size: 0.8em; color: #888; text-align: right;'>
+                {format_tiktok_time(created_at)}
+            </div>
+        </div>
+        """
+    return f"""
+        <div style='text-align: left; margin: 5px;'>
+            <div style='display: inline-block; background: #333; 
+                    color: white; padding: 10px 15px; border-radius: 18px 18px 18px 4px;'>
+                {content}
+            </div>
+            <div style='font-size: 0.8em; color: #888;'>
+                {format_tiktok_time(created_at)}
+            </div>
+        </div>
+        """
+
+@st.fragment(run_every=THEME_CONFIG['messages']['refresh_seconds'])
+def chat_panel(chat_id):
+    """Open conversation; reruns on its own and fetches only new messages"""
+    # Messages are cached per chat; each run only fetches what is new
+    page_size = THEME_CONFIG['messages']['page_size']
+    history = st.session_state.get('chat_history')
+    changed = events_changed("chat", ("user", st.session_state.user_id),
+                             lambda event: event['type'] == 'message'
+                             and chat_id in (event['sender_id'], event['receiver_id']))
+    if not history or history['chat_id'] != chat_id:
+        newest = get_messages(st.session_state.user_id, chat_id, limit=page_size + 1)
+        history = {
+            'chat_id': chat_id,
+            'messages': list(reversed(newest[:page_size])),
+            'has_older': len(newest) > page_size
+        }
+        st.session_state.chat_history = history
+    elif changed and history['messages']:
+        while True:
+            newer = get_messages(st.session_state.user_id, chat_id, limit=page_size,
+                                 after_id=history['messages'][-1][0])
+            history['messages'].extend(reversed(newer))
+            if len(newer) < page_size:
+                break
+    elif changed:
+        history['messages'] = list(reversed(get_messages(st.session_state.user_id, chat_id, limit=page_size)))
+    
+    if history['has_older'] and st.button("⬆️ Load older messages", use_container_width=True):
+        older = get_messages(st.session_state.user_id, chat_id, limit=page_size + 1,
+                             before_id=history['messages'][0][0])
+        history['messages'][:0] = reversed(older[:page_size])
+        history['has_older'] = len(older) > page_size
+    
+    # Display messages in a single markdown block
+    st.markdown(
+        "".join(render_chat_message(msg, st.session_state.user_id) for msg in history['messages']),
+        unsafe_allow_html=True
+    )
+    
+    # Message input
+    with st.form("chat_form", clear_on_submit=True):
+        message = st.text_input("Type your message...", key="message_input")
+        if st.form_submit_button("Send", use_container_width=True):
+            if message:
+                success, result = send_message(st.session_state.user_id, chat_id, message)
+                if success:
+                    st.rerun(scope="fragment")
+                else:
+                    st.error(result)
+
+@st.fragment(run_every=THEME_CONFIG['messages']['refresh_seconds'])
+def incoming_call_panel():
+    """Incoming call prompt; looks the call up again only after a call event"""
+    if events_changed("calls", ("user", st.session_state.user_id), lambda event: event['type'] == 'call'):
+        st.session_state.incoming_call = get_active_call(st.session_state.user_id)
+    
+    active_call = st.session_state.get('incoming_call')
     if active_call and len(active_call) > 5:
         caller_id = active_call[1]
         if caller_id != st.session_state.user_id:
@@ -2160,6 +4443,13 @@ def messages_page():
                     if st.button("❌ Decline", use_container_width=True):
                         end_call(active_call[4])
                         st.rerun()
+
+def messages_page():
+    """Messages page for chatting with other users"""
+    st.markdown("<h1 style='text-align: center;'>💬 Messages</h1>", unsafe_allow_html=True)
+    
+    # Check for incoming calls
+    incoming_call_panel()
     
     # Get conversations
     conversations = get_conversations(st.session_state.user_id)
@@ -2173,6 +4463,20 @@ def messages_page():
         if st.button("+ New Message", use_container_width=True):
             st.session_state.new_message = True
         
+        # Message search
+        message_query = st.text_input("Search messages", placeholder="Search messages...",
+                                      label_visibility="collapsed")
+        if message_query:
+            results = search_messages(st.session_state.user_id, message_query, limit=10)
+            if not results:
+                st.caption("No messages found")
+            for message_id, other_user_id, other_username, content, created_at in results:
+                preview = content[:40] + "..." if len(content) > 40 else content
+                if st.button(f"@{other_username}: {preview}", key=f"msg_hit_{message_id}", use_container_width=True):
+                    st.session_state.current_chat = other_user_id
+                    st.rerun()
+                st.caption(format_tiktok_time(created_at))
+        
         # Display conversations
         if conversations:
             for conv in conversations:
@@ -2227,61 +4531,7 @@ def messages_page():
                             )
                             st.rerun()
                 
-                # Messages container
-                messages = get_messages(st.session_state.user_id, st.session_state.current_chat)
-                
-                # Display messages
-                for msg in reversed(messages):
-                    if len(msg) > 3:
-                        content = msg[3]
-                        sender_id = msg[1]
-                        message_type = msg[4] if len(msg) > 4 else 'text'
-                        call_data = msg[6] if len(msg) > 6 else None
-                        created_at = msg[8] if len(msg) > 8 else ""
-                        
-                        is_sent = sender_id == st.session_state.user_id
-                        
-                        if message_type == 'call' and call_data:
-                            # Parse call data
-                            call_info = json.loads(call_data) if isinstance(call_data, str) else call_data
-                            if call_info:
-                                content = f"📞 {content}"
-                        
-                        if is_sent:
-                            st.markdown(f"""
-                            <div style='text-align: right; margin: 5px;'>
-                                <div style='display: inline-block; background: linear-gradient(45deg, #FF0050, #00F2EA); 
-                                        color: white; padding: 10px 15px; border-radius: 18px 18px 4px 18px;'>
-                                    {content}
-                                </div>
-                                <div style='font-size: 0.8em; color: #888; text-align: right;'>
-                                    {format_tiktok_time(created_at)}
-                                </div>
-                            </div>
-                            """, unsafe_allow_html=True)
-                        else:
-                            st.markdown(f"""
-                            <div style='text-align: left; margin: 5px;'>
-                                <div style='display: inline-block; background: #333; 
-                                        color: white; padding: 10px 15px; border-radius: 18px 18px 18px 4px;'>
-                                    {content}
-                                </div>
-                                <div style='font-size: 0.8em; color: #888;'>
-                                    {format_tiktok_time(created_at)}
-                                </div>
-                            </div>
-                            """, unsafe_allow_html=True)
-                
-                # Message input
-                with st.form("chat_form", clear_on_submit=True):
-                    message = st.text_input("Type your message...", key="message_input")
-                    if st.form_submit_button("Send", use_container_width=True):
-                        if message:
-                            success, result = send_message(st.session_state.user_id, st.session_state.current_chat, message)
-                            if success:
-                                st.rerun()
-                            else:
-                                st.error(result)
+                chat_panel(st.session_state.current_chat)
         else:
             st.info("💬 Select a conversation or start a new one")
         
@@ -2338,6 +4588,9 @@ def main():
         initial_sidebar_state="expanded"
     )
     
+    # Initialize database (once per process)
+    init_simple_db()
+    
     # Inject TikTok CSS
     inject_tiktok_css()
     
@@ -2352,7 +4605,15 @@ def main():
         'editing_profile': False,
         'current_stream': None,
         'watch_stream': None,
-        'call_user': None
+        'call_user': None,
+        'feed_cursor': None,
+        'following_cursor': None,
+        'open_comments': {},
+        'profile_cursor': None,
+        'chat_history': None,
+        'incoming_call': None,
+        'hashtag': None,
+        'hashtag_cursor': None
     }
     
     for key, value in default_state.items():